@@ -1,17 +1,37 @@
 import argparse
+from functools import partial
 import logging
-import os
 from pathlib import Path
-import shutil
 from dotenv import load_dotenv
-import pandas as pd
 
+from src.archive import AnswerArchive
 from src.datagen import AnswerGenerator
+from src.dedup import Deduplicator
 from src.config import PathProvider, SettingProvider, configure_logger
 from src.eval import Evaluator
+from src.export import AdapterMerger
 from src.server import LLMServer
 from src.sft import SFT
 from src.speciesismbench import StatementsLoader
+from src.stages import Stage, StageGraph
+from src.stats import summarize_evals
+from src.validation import Validator
+
+STAGE_NAMES = [
+    "load",
+    "datagen",
+    "dedup",
+    "sft",
+    "export",
+    "serve",
+    "validate",
+    "eval",
+    "stats",
+]
+
+# Settings that the variants of a sweep share, as they affect the shared stages
+SHARED_SETTINGS = ["model_id", "max_model_len", "tensor_parallel_size", "lora_rank"]
+SHARED_SETTING_PREFIXES = ["eval:", "grader_models:", "sweep:"]
 
 # PREPARE PIPELINE
 
@@ -23,28 +43,52 @@ cli_parser = argparse.ArgumentParser()
 cli_parser.add_argument(
     "-d", "--dev-mode", help="Run pipeline in development mode", action="store_true"
 )
+cli_parser.add_argument(
+    "--from",
+    dest="first_stage",
+    choices=STAGE_NAMES,
+    help="First stage to run (re-runs it, and later stages that use its outputs)",
+)
+cli_parser.add_argument(
+    "--to",
+    dest="last_stage",
+    choices=STAGE_NAMES,
+    help="Last stage to run (re-runs it even if its outputs exist)",
+)
+cli_parser.add_argument(
+    "-n",
+    "--dry-run",
+    help="Print which stages would run or be reused, then exit",
+    action="store_true",
+)
+cli_parser.add_argument(
+    "--sweep",
+    help="Run all variants in the setting `sweep:variants`, sharing base-model work",
+    action="store_true",
+)
 cli_args = cli_parser.parse_args()
+if cli_args.sweep and (cli_args.first_stage or cli_args.last_stage):
+    cli_parser.error("--from and --to can't be combined with --sweep.")
 mode = "dev" if cli_args.dev_mode else "standard"
 
 # Prepare config providers
 paths = PathProvider(mode=mode)
 settings = SettingProvider(mode=mode)
 
-# Create outputs folder
-if Path.is_dir(paths.outputs_folder_path):
-    raise RuntimeError(
-        f"The outputs folder ('{paths.outputs_folder_path}') already exists. "
-        "Back up its contents and delete the folder to continue."
-    )
-os.makedirs(paths.outputs_folder_path)
+# The export stage is opt-in, as no other stage uses the merged model
+stage_names = [n for n in STAGE_NAMES if n != "export" or settings["export:enabled"]]
+if "export" in [cli_args.first_stage, cli_args.last_stage] and (
+    "export" not in stage_names
+):
+    cli_parser.error("Stage 'export' is disabled; set `export:enabled: True`.")
 
 # Prepare cache folder
-if not Path.is_dir(paths.cache_folder_path):
+if not cli_args.dry_run and not Path.is_dir(paths.cache_folder_path):
     Path.mkdir(paths.cache_folder_path, parents=True)
 
 # Prepare logger
 logger_name = "pipeline"
-log_folder_path = paths.outputs_folder_path
+log_folder_path = None if cli_args.dry_run else paths.outputs_folder_path
 log_level = settings["log_level"]
 configure_logger(
     logger_name=logger_name, log_folder_path=log_folder_path, log_level=log_level
@@ -54,58 +98,269 @@ logger = logging.getLogger(logger_name)
 if mode == "dev":
     logger.info("Running pipeline in development mode. Outputs will not be useful.")
 
-# LOAD SPECIESISMBENCH (i.e., speciesist statements)
+# Without sweep, there is a single, untagged variant
+variants = list(settings["sweep:variants"]) if cli_args.sweep else [None]
+for variant in variants:
+    if variant is None:
+        continue
+    for setting_id in settings["sweep:variants"][variant] or {}:
+        if setting_id in SHARED_SETTINGS or any(
+            setting_id.startswith(p) for p in SHARED_SETTING_PREFIXES
+        ):
+            raise ValueError(
+                f"Sweep variant '{variant}' overrides the shared setting "
+                f"'{setting_id}'."
+            )
 
 statements_loader = StatementsLoader(mode=mode)
-training_statements = statements_loader.load(split="training")
+statements_file_path = paths.cache_folder_path / "speciesismbench.csv"
+evals_folder_path = paths.outputs_folder_path / "evals"
+
+# With the in-process backend, eval doesn't need the server
+eval_dependencies = []
+if settings["eval:backend"] == "server":
+    eval_dependencies.append("serve")
+
+host = "127.0.0.1"
+port = 8000
+server = LLMServer(mode=mode, host=host, port=port)
+
+
+def tag(stage_name, variant):
+    return stage_name if variant is None else f"{variant}/{stage_name}"
+
+
+# LOAD SPECIESISMBENCH (i.e., speciesist statements)
+
+
+def load_statements():
+    statements_loader.load(split="training")
+
 
 # GENERATE DATA (i.e., answers to questions about speciesist statements)
 
-answers_file_name = "answers.pkl"
-answers_file_path = paths.cache_folder_path / answers_file_name
-answers = None
 
-if Path.is_file(answers_file_path):
-    logger.debug(f"Found '{answers_file_name}' in cache.")
-    logger.info("Found dataset in cache. Skipping dataset generation.")
-    answers = pd.read_pickle(answers_file_path)
-else:
+def generate_answers(variant):
     answer_generator = AnswerGenerator(
         mode=mode,
-        statements=training_statements,
-        system_message=settings["system_message"],
+        statements=statements_loader.load(split="training"),
+        system_message=SettingProvider(mode=mode, variant=variant)["system_message"],
+        variant=variant,
     )
-    answers = answer_generator.generate()
+    answer_generator.generate()
+
+
+# PRUNE NEAR-DUPLICATE ANSWERS
+
+
+def deduplicate(variant):
+    Deduplicator(mode=mode, variant=variant).deduplicate()
+
 
 # FINETUNE (i.e., run SFT on the generated question-answer pairs)
 
-checkpoints_folder_name = "checkpoints"
-checkpoints_folder_path = paths.cache_folder_path / checkpoints_folder_name
 
-if Path.is_dir(checkpoints_folder_path):
-    logger.debug(f"Found folder '{checkpoints_folder_name}' in cache.")
-    logger.info("Found SFT checkpoints in cache. Skipping SFT.")
-else:
-    Path.mkdir(checkpoints_folder_path)
+def finetune(variant):
+    checkpoints_folder_path = PathProvider(
+        mode=mode, variant=variant
+    ).checkpoints_folder_path
+    Path.mkdir(checkpoints_folder_path, parents=True)
+    sft = SFT(
+        mode=mode, statements=statements_loader.load(split="training"), variant=variant
+    )
+    sft.finetune()
+
+
+# EXPORT (i.e., merge a checkpoint's adapter into the base model)
+
+
+def export(variant):
+    AdapterMerger(mode=mode, variant=variant).merge()
 
-    try:
-        sft = SFT(mode=mode, statements=training_statements, answers=answers)
-        sft.finetune()
-    except Exception as exception:
-        shutil.rmtree(checkpoints_folder_path)
-        raise exception
 
 # EVALUATE RESULTS
 
-host = "127.0.0.1"
-port = 8000
 
-server = LLMServer(mode=mode, host=host, port=port)
-server.start()
-server.wait_until_ready()
+def serve():
+    server.start()
+    server.wait_until_ready()
+
+
+def validate(variant, scope):
+    validator = Validator(
+        mode=mode,
+        server_host=host,
+        server_port=port,
+        statements=statements_loader.load(split="validation"),
+        variant=variant,
+        scope=scope,
+    )
+    validator.validate()
 
-try:
-    evaluator = Evaluator(mode=mode, server_host=host, server_port=port)
+
+def evaluate(variant, scope):
+    evaluator = Evaluator(
+        mode=mode, server_host=host, server_port=port, variant=variant, scope=scope
+    )
     evaluator.evaluate()
-finally:
-    server.stop()
+
+
+def summarize(evals_folder_paths, scores_file_path):
+    scores = summarize_evals(evals_folder_paths, scores_file_path)
+    logger.info(f"Scores of {len(scores)} eval runs saved to '{scores_file_path}'.")
+
+
+# RUN STAGES
+
+
+def add_training_stages(graph, variant):
+    variant_paths = PathProvider(mode=mode, variant=variant)
+    training_answers_path = AnswerArchive(mode=mode, variant=variant).partition_path(
+        split="training"
+    )
+    dedup_file_path = Deduplicator(mode=mode, variant=variant).file_path
+    checkpoints_folder_path = variant_paths.checkpoints_folder_path
+
+    graph.add(
+        Stage(
+            tag("datagen", variant),
+            run=partial(generate_answers, variant),
+            inputs=[statements_file_path],
+            outputs=[training_answers_path],
+            depends_on=["load"],
+        )
+    )
+    graph.add(
+        Stage(
+            tag("dedup", variant),
+            run=partial(deduplicate, variant),
+            inputs=[training_answers_path],
+            outputs=[dedup_file_path],
+            depends_on=[tag("datagen", variant)],
+        )
+    )
+    graph.add(
+        Stage(
+            tag("sft", variant),
+            run=partial(finetune, variant),
+            inputs=[statements_file_path, training_answers_path, dedup_file_path],
+            outputs=[checkpoints_folder_path],
+            depends_on=["load", tag("datagen", variant), tag("dedup", variant)],
+        )
+    )
+    if not SettingProvider(mode=mode, variant=variant)["export:enabled"]:
+        return
+    graph.add(
+        Stage(
+            tag("export", variant),
+            run=partial(export, variant),
+            inputs=[checkpoints_folder_path],
+            # Per checkpoint, so that changing `export:checkpoint` merges again
+            outputs=[AdapterMerger(mode=mode, variant=variant).merged_model_path()],
+            depends_on=[tag("sft", variant)],
+        )
+    )
+
+
+def add_validation_stage(graph, variant, scope):
+    variant_paths = PathProvider(mode=mode, variant=variant)
+    validation_answers_path = AnswerArchive(mode=mode, variant=variant).partition_path(
+        split="validation"
+    )
+    graph.add(
+        Stage(
+            tag("validate", variant),
+            run=partial(validate, variant, scope),
+            inputs=[statements_file_path, variant_paths.checkpoints_folder_path],
+            outputs=[validation_answers_path],
+            depends_on=["load", tag("sft", variant), "serve"],
+            resumable=True,
+        )
+    )
+
+
+def add_eval_stages(graph, variant, scope, shared_evals_folder_path=None):
+    variant_paths = PathProvider(mode=mode, variant=variant)
+    variant_evals_folder_path = variant_paths.outputs_folder_path / "evals"
+    scores_file_path = variant_paths.outputs_folder_path / "scores.csv"
+    graph.add(
+        Stage(
+            tag("eval", variant),
+            run=partial(evaluate, variant, scope),
+            inputs=[variant_paths.checkpoints_folder_path],
+            outputs=[variant_evals_folder_path],
+            depends_on=[tag("sft", variant)] + eval_dependencies,
+            resumable=True,
+        )
+    )
+
+    evals_folder_paths = [variant_evals_folder_path]
+    stats_dependencies = [tag("eval", variant)]
+    if shared_evals_folder_path is not None:
+        evals_folder_paths.insert(0, shared_evals_folder_path)
+        stats_dependencies.insert(0, "eval")
+    graph.add(
+        Stage(
+            tag("stats", variant),
+            run=partial(summarize, evals_folder_paths, scores_file_path),
+            inputs=evals_folder_paths,
+            outputs=[scores_file_path],
+            depends_on=stats_dependencies,
+        )
+    )
+
+
+graph = StageGraph()
+graph.add(Stage("load", run=load_statements, outputs=[statements_file_path]))
+for variant in variants:
+    add_training_stages(graph, variant)
+graph.add(
+    Stage(
+        "serve",
+        run=serve,
+        inputs=[
+            PathProvider(mode=mode, variant=v).checkpoints_folder_path for v in variants
+        ],
+        depends_on=[tag("sft", v) for v in variants],
+        teardown=server.stop,
+    )
+)
+
+if cli_args.sweep:
+    # The "pre-distill" model without system prompt is validated and evaluated
+    # once for all variants
+    graph.add(
+        Stage(
+            "validate",
+            run=partial(validate, None, "shared"),
+            inputs=[statements_file_path],
+            outputs=[AnswerArchive(mode=mode).partition_path(split="validation")],
+            depends_on=["load", "serve"],
+            resumable=True,
+        )
+    )
+    for variant in variants:
+        add_validation_stage(graph, variant, scope="variant")
+    graph.add(
+        Stage(
+            "eval",
+            run=partial(evaluate, None, "shared"),
+            outputs=[evals_folder_path],
+            depends_on=eval_dependencies,
+            resumable=True,
+        )
+    )
+    for variant in variants:
+        add_eval_stages(
+            graph, variant, scope="variant", shared_evals_folder_path=evals_folder_path
+        )
+else:
+    add_validation_stage(graph, variant=None, scope="all")
+    add_eval_stages(graph, variant=None, scope="all")
+    assert graph.stage_names == stage_names
+
+if cli_args.dry_run:
+    decisions = graph.plan(first=cli_args.first_stage, last=cli_args.last_stage)
+    print(graph.describe(decisions))
+else:
+    graph.run(first=cli_args.first_stage, last=cli_args.last_stage)
@@ -0,0 +1,178 @@
+import argparse
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow.fs import LocalFileSystem
+import pyarrow.parquet as pq
+
+from src.config import PathProvider
+
+_SCHEMA = pa.schema(
+    [
+        ("statement_id", pa.int64()),
+        ("sample", pa.int32()),
+        ("text", pa.large_string()),
+    ]
+)
+
+
+class AnswerArchive:
+    """
+    A Parquet store for all generated answers.
+
+    There is one row per answer, with the columns `split`, `model`,
+    `statement_id`, `sample` (starting at 1), and `text`. The store is indexed
+    as follows: `split` and `model` are Hive partitions (i.e. folders such as
+    `split=training/model=pre-distill-prompted`), and within each partition,
+    rows are sorted by `statement_id` and `sample`, in small row groups. Hence,
+    queries only read the partitions and row groups they need, and only the
+    requested columns. Files are memory-mapped.
+
+    Usage:
+
+    ```
+    archive = AnswerArchive(mode=...)
+    archive.write(split="validation", model="checkpoint-0030", answers=...)
+    archive.query(split="validation", statement_ids=[1, 17], columns=["model", "text"])
+    ```
+    """
+
+    def __init__(self, mode, variant=None, row_group_size=256):
+        self._paths = PathProvider(mode=mode, variant=variant)
+        self._row_group_size = row_group_size
+
+    @property
+    def folder_path(self):
+        return self._paths.cache_folder_path / "answers"
+
+    def partition_path(self, split, model=None):
+        partition_path = self.folder_path / f"split={split}"
+        if model is not None:
+            partition_path = partition_path / f"model={model}"
+        return partition_path
+
+    def contains(self, split, model):
+        """
+        Whether the answers of `model` to statements of the given `split` were
+        saved.
+        """
+
+        return (self.partition_path(split, model) / "answers.parquet").is_file()
+
+    def write(self, split, model, answers):
+        """
+        Save the `answers` of `model` to statements of the given `split`,
+        replacing any previous ones.
+
+        :param answers: `DataFrame` with one row per statement (indexed by
+            statement ID) and the columns `Answer 1`, `Answer 2`, etc.
+        """
+
+        long_answers = answers.rename_axis("statement_id").reset_index()
+        long_answers = long_answers.melt(
+            id_vars="statement_id", var_name="sample", value_name="text"
+        )
+        long_answers["sample"] = (
+            long_answers["sample"].str.removeprefix("Answer ").astype("int32")
+        )
+        long_answers = long_answers.sort_values(["statement_id", "sample"])
+        table = pa.Table.from_pandas(long_answers, schema=_SCHEMA, preserve_index=False)
+
+        partition_path = self.partition_path(split, model)
+        if partition_path.exists():
+            shutil.rmtree(partition_path)
+        partition_path.mkdir(parents=True)
+        pq.write_table(
+            table,
+            partition_path / "answers.parquet",
+            row_group_size=self._row_group_size,
+            compression="zstd",
+        )
+
+    def _get_filter(self, split, model, statement_ids, samples):
+        conditions = []
+        if split is not None:
+            conditions.append(ds.field("split") == split)
+        if model is not None:
+            conditions.append(ds.field("model") == model)
+        if statement_ids is not None:
+            conditions.append(ds.field("statement_id").isin(list(statement_ids)))
+        if samples is not None:
+            conditions.append(ds.field("sample").isin(list(samples)))
+        if not conditions:
+            return None
+        combined = conditions[0]
+        for condition in conditions[1:]:
+            combined = combined & condition
+        return combined
+
+    def _get_dataset(self):
+        return ds.dataset(
+            self.folder_path,
+            format="parquet",
+            partitioning="hive",
+            filesystem=LocalFileSystem(use_mmap=True),
+        )
+
+    def query(
+        self, split=None, model=None, statement_ids=None, samples=None, columns=None
+    ):
+        """
+        Return the matching answers as a `DataFrame`, restricted to `columns`
+        (all columns if `None`).
+        """
+
+        table = self._get_dataset().to_table(
+            columns=columns,
+            filter=self._get_filter(split, model, statement_ids, samples),
+        )
+        return table.to_pandas()
+
+    def iter_rows(self, split, model, columns=None, batch_size=1024):
+        """
+        Stream the answers of `model` to statements of the given `split` as
+        dicts, without loading all of them into memory at once.
+        """
+
+        batches = self._get_dataset().to_batches(
+            columns=columns,
+            filter=self._get_filter(split, model, None, None),
+            batch_size=batch_size,
+        )
+        for batch in batches:
+            yield from batch.to_pylist()
+
+    def models(self, split):
+        partition_path = self.partition_path(split)
+        if not partition_path.is_dir():
+            return []
+        return sorted(
+            p.name.removeprefix("model=")
+            for p in partition_path.iterdir()
+            if p.name.startswith("model=")
+        )
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(description="Print archived answers.")
+    cli_parser.add_argument("--dev-mode", action="store_true")
+    cli_parser.add_argument("--variant", help="Sweep variant")
+    cli_parser.add_argument("--split", default="validation")
+    cli_parser.add_argument("--model")
+    cli_parser.add_argument("--statement-id", type=int, action="append")
+    cli_parser.add_argument("--sample", type=int, action="append")
+    cli_args = cli_parser.parse_args()
+
+    archive = AnswerArchive(
+        mode="dev" if cli_args.dev_mode else "standard", variant=cli_args.variant
+    )
+    answers = archive.query(
+        split=cli_args.split,
+        model=cli_args.model,
+        statement_ids=cli_args.statement_id,
+        samples=cli_args.sample,
+        columns=["model", "statement_id", "sample", "text"],
+    )
+    for row in answers.itertuples():
+        print(f"### {row.model} | Statement #{row.statement_id} | Answer {row.sample}")
+        print(f"{row.text}\n")
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import os
+from time import perf_counter
+from inspect_ai.model import GenerateConfig
+from openai import AsyncOpenAI
+
+from src.config import PathProvider, SettingProvider, configure_logger
+from src.inprocess import InProcessEngine
+from src.server import LLMServer
+from src.speciesismbench import StatementsLoader
+
+
+class _Benchmark:
+    """
+    Measures the throughput of the eval backends (`server` vs. `in-process`)
+    by sending the same chat requests to the "pre-distill" model and the last
+    checkpoint through each backend.
+    """
+
+    def __init__(self, mode, num_requests, concurrency):
+        self._settings = SettingProvider(mode=mode)
+        self._paths = PathProvider(mode=mode)
+        self._mode = mode
+        self._num_requests = num_requests
+        self._concurrency = concurrency
+
+    def _get_requests(self):
+        statements = StatementsLoader(mode=self._mode).load(split="validation")
+        folder_entries = os.listdir(self._paths.checkpoints_folder_path)
+        checkpoint_ids = sorted(
+            [f for f in folder_entries if f.startswith("checkpoint-")]
+        )
+        model_ids = [
+            self._settings["model_id"],
+            self._paths.checkpoint_model_id(checkpoint_ids[-1]),
+        ]
+        user_message_suffix = self._settings["user_message_suffix"]
+        requests = []
+        for i in range(self._num_requests):
+            statement = statements.iloc[i % len(statements)]
+            messages = [
+                {"role": "user", "content": f'"{statement}"\n{user_message_suffix}'}
+            ]
+            requests.append((model_ids[i % len(model_ids)], messages))
+        return requests
+
+    async def _run(self, requests, generate):
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def run_one(model_id, messages):
+            async with semaphore:
+                return await generate(model_id, messages)
+
+        start_time = perf_counter()
+        output_tokens = await asyncio.gather(*[run_one(*r) for r in requests])
+        duration = perf_counter() - start_time
+        return len(requests) / duration, sum(output_tokens) / duration
+
+    def _run_server(self, requests):
+        host, port = "127.0.0.1", 8000
+        server = LLMServer(mode=self._mode, host=host, port=port)
+        client = AsyncOpenAI(base_url=f"http://{host}:{port}/v1", api_key="none")
+
+        async def generate(model_id, messages):
+            completion = await client.chat.completions.create(
+                model=model_id, messages=messages
+            )
+            return completion.usage.completion_tokens
+
+        server.start()
+        try:
+            server.wait_until_ready()
+            return asyncio.run(self._run(requests, generate))
+        finally:
+            server.stop()
+
+    def _run_in_process(self, requests):
+        engine = InProcessEngine(mode=self._mode)
+
+        async def generate(model_id, messages):
+            output = await engine.generate(model_id, messages, GenerateConfig())
+            return len(output.outputs[0].token_ids)
+
+        engine.start()
+        try:
+            return asyncio.run(self._run(requests, generate))
+        finally:
+            engine.stop()
+
+    def run(self, backends):
+        requests = self._get_requests()
+        results = {}
+        for backend in backends:
+            if backend == "server":
+                results[backend] = self._run_server(requests)
+            else:
+                results[backend] = self._run_in_process(requests)
+
+        print(f"{'Backend':10} | {'Requests/s':>10} | {'Tokens/s':>10}")
+        for backend, (requests_per_s, tokens_per_s) in results.items():
+            print(f"{backend:10} | {requests_per_s:10.2f} | {tokens_per_s:10.1f}")
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(description="Compare eval backends.")
+    cli_parser.add_argument("-d", "--dev-mode", action="store_true")
+    cli_parser.add_argument("--num-requests", type=int, default=256)
+    cli_parser.add_argument("--concurrency", type=int, default=64)
+    cli_parser.add_argument(
+        "--backend",
+        action="append",
+        choices=["server", "in-process"],
+        help="Backend to benchmark (default: both)",
+    )
+    cli_args = cli_parser.parse_args()
+    mode = "dev" if cli_args.dev_mode else "standard"
+    paths = PathProvider(mode=mode)
+    configure_logger(
+        logger_name="pipeline",
+        log_folder_path=paths.outputs_folder_path,
+        log_level="info",
+    )
+
+    benchmark = _Benchmark(
+        mode=mode,
+        num_requests=cli_args.num_requests,
+        concurrency=cli_args.concurrency,
+    )
+    benchmark.run(backends=cli_args.backend or ["server", "in-process"])
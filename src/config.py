@@ -5,28 +5,72 @@ import yaml
 
 
 class PathProvider:
-    """For easy access to files and directories within the repo."""
+    """
+    For easy access to files and directories within the repo.
 
-    def __init__(self, mode):
+    If a sweep `variant` is given, the cache and outputs folders are those of
+    that variant (e.g. `cache/variants/antispeciesist`).
+    """
+
+    def __init__(self, mode, variant=None):
         self._mode = mode
+        self._variant = variant
 
     @property
     def repo_folder_path(self):
         # The parent folder of the folder that contains this file
         return Path(__file__).resolve().parent.parent
 
+    def _tag(self, folder_path):
+        if self._variant is None:
+            return folder_path
+        return folder_path / "variants" / self._variant
+
     @property
-    def cache_folder_path(self):
+    def shared_cache_folder_path(self):
         if self._mode == "dev":
             return self.repo_folder_path / "cache_dev"
         return self.repo_folder_path / "cache"
 
     @property
-    def outputs_folder_path(self):
+    def cache_folder_path(self):
+        return self._tag(self.shared_cache_folder_path)
+
+    @property
+    def shared_outputs_folder_path(self):
         if self._mode == "dev":
             return self.repo_folder_path / "outputs_dev"
         return self.repo_folder_path / "outputs"
 
+    @property
+    def outputs_folder_path(self):
+        return self._tag(self.shared_outputs_folder_path)
+
+    @property
+    def history_folder_path(self):
+        """
+        For records that outlive the cache and outputs folders (e.g. the
+        throughput of past runs).
+        """
+
+        if self._mode == "dev":
+            return self.repo_folder_path / "history_dev"
+        return self.repo_folder_path / "history"
+
+    @property
+    def checkpoints_folder_path(self):
+        return self.cache_folder_path / "checkpoints"
+
+    def checkpoint_model_id(self, checkpoint_id):
+        """
+        The model ID under which vLLM serves a checkpoint (e.g.
+        `checkpoints/checkpoint-0030`): its path relative to the shared cache
+        folder, so that the checkpoints of all variants can be served at once.
+        """
+
+        checkpoint_path = self.checkpoints_folder_path / checkpoint_id
+        return str(checkpoint_path.relative_to(self.shared_cache_folder_path))
+
 
 class _SettingsFilePathProvider(PathProvider):
     def __init__(self, mode):
@@ -64,10 +108,14 @@ class SettingProvider:
        Look for `key` in the file `settings.settings_file_path`.
     3. If `key` not found:
        Throw a `KeyError`.
+
+    If a sweep `variant` is given, its overrides (in the setting
+    `sweep:variants`) take precedence over all of the above.
     """
 
-    def __init__(self, mode):
+    def __init__(self, mode, variant=None):
         self._mode = mode
+        self._variant = variant
         self._paths = _SettingsFilePathProvider(mode=self._mode)
         self._dev_settings = None
         self._settings = None
@@ -81,7 +129,20 @@ class SettingProvider:
             with self._paths.dev_settings_file_path.open() as dev_settings_file:
                 self._dev_settings = yaml.safe_load(dev_settings_file)
 
+    def _get_variant_overrides(self):
+        variants = self._get_setting("sweep:variants")
+        if self._variant not in variants:
+            raise KeyError(f"Unknown sweep variant '{self._variant}'.")
+        return variants[self._variant] or {}
+
     def __getitem__(self, setting_id):
+        if self._variant is not None:
+            overrides = self._get_variant_overrides()
+            if setting_id in overrides:
+                return overrides[setting_id]
+        return self._get_setting(setting_id)
+
+    def _get_setting(self, setting_id):
         if self._mode == "dev":
             try:
                 return self._dev_settings[setting_id]
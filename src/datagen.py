@@ -1,19 +1,132 @@
+import argparse
+from collections import Counter
+from dataclasses import dataclass
 import logging
+import multiprocessing
+import os
+import shutil
+from time import perf_counter
 import pandas as pd
-from vllm import LLM
+from vllm import LLM, SamplingParams
 from tqdm import tqdm
 
-from .config import PathProvider, SettingProvider
+from .archive import AnswerArchive
+from .config import PathProvider, SettingProvider, configure_logger
+from .devices import assign_devices
+from .reasoning import THINK_END, join_reasoning, split_reasoning
+from .throughput import ThroughputLog
+
+
+# The name of the model whose answers are generated, in `AnswerArchive`
+MODEL_NAME = "pre-distill-prompted"
+
+
+def create_vllm_engine(settings):
+    return LLM(
+        settings["model_id"],
+        tensor_parallel_size=settings["tensor_parallel_size"],
+        max_model_len=settings["max_model_len"],
+        gpu_memory_utilization=settings["datagen:gpu_memory_utilization"],
+    )
+
+
+@dataclass
+class _FakeCompletion:
+    text: str
+    token_ids: list[int]
+    finish_reason: str
+
+
+@dataclass
+class _FakeOutput:
+    outputs: list[_FakeCompletion]
+
+
+class FakeEngine:
+    """
+    A stand-in for `vllm.LLM` that runs on CPU, e.g. to check data-parallel
+    datagen without GPUs (see `check_data_parallel`).
+
+    Each of the `n` answers to a chat repeats the chat's last message, with
+    one token per word, cut at `max_tokens`.
+    """
+
+    def __init__(self, settings):
+        self._settings = settings
+
+    def get_default_sampling_params(self):
+        return SamplingParams()
+
+    def chat(
+        self,
+        messages,
+        sampling_params,
+        use_tqdm=True,
+        add_generation_prompt=True,
+        continue_final_message=False,
+    ):
+        conversations = [messages] if isinstance(messages[0], dict) else messages
+        outputs = []
+        for conversation in conversations:
+            completions = []
+            for j in range(sampling_params.n):
+                words = [f"({j + 1})"] + conversation[-1]["content"].split()
+                kept_words = words[: sampling_params.max_tokens]
+                completions.append(
+                    _FakeCompletion(
+                        text=" ".join(kept_words),
+                        token_ids=list(range(len(kept_words))),
+                        finish_reason="stop" if kept_words == words else "length",
+                    )
+                )
+            outputs.append(_FakeOutput(outputs=completions))
+        return outputs
+
+
+def _generate_shard(
+    mode,
+    variant,
+    statements,
+    system_message,
+    engine_factory,
+    devices,
+    shard_file_path,
+    shard_id,
+):
+    """
+    Entry point of a data-parallel worker process.
+
+    Generates answers to the given `statements` on the given `devices` and
+    saves them to `shard_file_path`.
+    """
+
+    if devices is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(devices)
+    settings = SettingProvider(mode=mode, variant=variant)
+    configure_logger(logger_name="pipeline", log_level=settings["log_level"])
+    answer_generator = AnswerGenerator(
+        mode=mode,
+        statements=statements,
+        system_message=system_message,
+        engine_factory=engine_factory,
+        variant=variant,
+    )
+    answers = answer_generator.generate_shard(shard_id=shard_id)
+    answers.to_parquet(shard_file_path)
 
 
 class AnswerGenerator:
-    def __init__(self, mode, statements, system_message):
+    def __init__(
+        self, mode, statements, system_message, engine_factory=None, variant=None
+    ):
         self._mode = mode
+        self._variant = variant
         self._logger = logging.getLogger("pipeline")
-        self._settings = SettingProvider(mode=mode)
-        self._paths = PathProvider(mode=mode)
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode, variant=variant)
         self._statements = statements
         self._system_message = system_message
+        self._engine_factory = engine_factory or create_vllm_engine
         self._llm = None
         self._column_names = [
             f"Answer {j + 1}"
@@ -23,6 +136,7 @@ class AnswerGenerator:
             index=self._statements.index,
             columns=self._column_names,
         )
+        self._token_counts = Counter()
 
     def _get_chat(self, statement):
         user_message_suffix = self._settings["user_message_suffix"]
@@ -34,8 +148,8 @@ class AnswerGenerator:
             },
         ]
 
-    def _token_limit_exceeded(self, statement_id, output):
-        for j, o in enumerate(output.outputs):
+    def _token_limit_exceeded(self, statement_id, completions):
+        for j, o in enumerate(completions):
             # https://docs.vllm.ai/en/v0.9.0.1/api/vllm/v1/engine/index.html#vllm.v1.engine.FinishReason
             if o.finish_reason != "stop":
                 return True, (
@@ -45,9 +159,9 @@ class AnswerGenerator:
                 )
         return False, ""
 
-    def _validate_output(self, statement_id, output):
+    def _validate_output(self, statement_id, completions):
         token_limit_exceeded, message = self._token_limit_exceeded(
-            statement_id=statement_id, output=output
+            statement_id=statement_id, completions=completions
         )
         if token_limit_exceeded:
             if self._mode == "standard":
@@ -62,35 +176,253 @@ class AnswerGenerator:
         )
         return sampling_params
 
-    def generate(self):
-        self._logger.info("Generating answers...")
-        self._llm = LLM(
-            self._settings["model_id"],
-            tensor_parallel_size=self._settings["tensor_parallel_size"],
-            max_model_len=self._settings["max_model_len"],
-            gpu_memory_utilization=self._settings["datagen:gpu_memory_utilization"],
+    def _get_thinking_sampling_params(self, sampling_params, thinking_budget):
+        """
+        Split `sampling_params` into those for a reasoning phase, which stops
+        at the end of the reasoning or after `thinking_budget` tokens, and those
+        for an answer phase, which continues each reasoning.
+        """
+
+        thinking_params = sampling_params.clone()
+        thinking_params.max_tokens = thinking_budget
+        thinking_params.stop = [THINK_END]
+        answer_params = sampling_params.clone()
+        answer_params.n = 1
+        answer_params.max_tokens = max(
+            100, sampling_params.max_tokens - thinking_budget
+        )
+        return thinking_params, answer_params
+
+    def _chat(self, chat, sampling_params):
+        [output] = self._llm.chat(
+            chat,
+            sampling_params=sampling_params,
+            use_tqdm=False,
         )
-        self._logger.debug(
-            f"Using this vLLM config: {self._llm.llm_engine.vllm_config}"
+        self._token_counts["answer"] += sum(len(o.token_ids) for o in output.outputs)
+        return [o.text for o in output.outputs], output.outputs
+
+    def _chat_with_thinking_budget(self, chat, thinking_params, answer_params):
+        [thinking_output] = self._llm.chat(
+            chat,
+            sampling_params=thinking_params,
+            use_tqdm=False,
+        )
+        reasonings = []
+        for o in thinking_output.outputs:
+            self._token_counts["reasoning"] += len(o.token_ids)
+            if o.finish_reason == "length":
+                self._token_counts["truncated_reasonings"] += 1
+            reasoning, _ = split_reasoning(o.text + THINK_END)
+            reasonings.append(reasoning)
+
+        # Continue each (possibly truncated) reasoning with the final answer
+        conversations = [
+            chat + [{"role": "assistant", "content": join_reasoning(r, "")}]
+            for r in reasonings
+        ]
+        answer_outputs = self._llm.chat(
+            conversations,
+            sampling_params=answer_params,
+            use_tqdm=False,
+            add_generation_prompt=False,
+            continue_final_message=True,
+        )
+        completions = [o.outputs[0] for o in answer_outputs]
+        self._token_counts["answer"] += sum(len(c.token_ids) for c in completions)
+        texts = [join_reasoning(r, c.text) for r, c in zip(reasonings, completions)]
+        return texts, completions
+
+    def _log_token_counts(self, num_answers):
+        answer_tokens = self._token_counts["answer"]
+        reasoning_tokens = self._token_counts["reasoning"]
+        message = f"Generated {reasoning_tokens + answer_tokens} tokens"
+        if reasoning_tokens > 0:
+            truncated = self._token_counts["truncated_reasonings"]
+            message += (
+                f" ({reasoning_tokens} for reasoning). The reasoning of {truncated} "
+                f"of {num_answers} answers was cut at the thinking budget "
+                f"({self._settings['datagen:thinking_budget']} tokens)"
+            )
+        self._logger.info(f"{message}.")
+
+    def _record_throughput(self, duration):
+        num_tokens = self._token_counts["answer"] + self._token_counts["reasoning"]
+        throughput_log = ThroughputLog(mode=self._mode, variant=self._variant)
+        throughput_log.record("datagen:tokens_per_s", num_tokens / duration)
+        throughput_log.record(
+            "datagen:tokens_per_answer", num_tokens / self._answers.size
         )
 
+    def generate_shard(self, shard_id=0):
+        """
+        Generate answers to all statements using a single engine.
+        """
+
+        self._llm = self._engine_factory(self._settings)
+        if hasattr(self._llm, "llm_engine"):
+            self._logger.debug(
+                f"Using this vLLM config: {self._llm.llm_engine.vllm_config}"
+            )
+
         sampling_params = self._get_sampling_params()
         self._logger.debug(f"Using these sampling params: {sampling_params}")
+        thinking_budget = self._settings["datagen:thinking_budget"]
+        if thinking_budget is not None:
+            thinking_params, answer_params = self._get_thinking_sampling_params(
+                sampling_params, thinking_budget
+            )
 
-        for statement_id in tqdm(self._statements.index):
+        start_time = perf_counter()
+        for statement_id in tqdm(
+            self._statements.index, desc=f"Shard {shard_id}", position=shard_id
+        ):
             statement = self._statements[statement_id]
             chat = self._get_chat(statement)
-            [output] = self._llm.chat(
-                chat,
-                sampling_params=sampling_params,
-                use_tqdm=False,
-            )
-            self._validate_output(statement_id=statement_id, output=output)
-            answers = [o.text for o in output.outputs]
+            if thinking_budget is None:
+                answers, completions = self._chat(chat, sampling_params)
+            else:
+                answers, completions = self._chat_with_thinking_budget(
+                    chat, thinking_params, answer_params
+                )
+            self._validate_output(statement_id=statement_id, completions=completions)
             self._answers.loc[statement_id, :] = answers
             self._logger.debug(f"Prompted LLM using statement #{statement_id}.")
 
-        pkl_file_path = self._paths.cache_folder_path / "answers.pkl"
-        self._answers.to_pickle(pkl_file_path)
-        self._logger.info(f"Answers generated and saved to '{pkl_file_path}'.")
+        self._log_token_counts(num_answers=self._answers.size)
+        if isinstance(self._llm, LLM):  # Not e.g. a `FakeEngine`
+            self._record_throughput(duration=perf_counter() - start_time)
+        return self._answers
+
+    @property
+    def shards_folder_path(self):
+        return self._paths.cache_folder_path / "answers-shards"
+
+    def _generate_data_parallel(self, data_parallel_size):
+        shards_folder_path = self.shards_folder_path
+        shards_folder_path.mkdir(parents=True, exist_ok=True)
+        devices = assign_devices(
+            num_groups=data_parallel_size,
+            group_size=self._settings["tensor_parallel_size"],
+        )
+
+        shard_file_paths = []
+        processes = {}
+        context = multiprocessing.get_context("spawn")
+
+        for i in range(data_parallel_size):
+            shard_file_path = (
+                # Numbered from 0, like the shards in the logs
+                shards_folder_path / f"{i:02d}-of-{data_parallel_size:02d}.parquet"
+            )
+            shard_file_paths.append(shard_file_path)
+            if shard_file_path.is_file():
+                self._logger.info(f"Found shard {i} in cache. Skipping it.")
+                continue
+            # Round-robin assignment balances statement lengths across shards
+            process = context.Process(
+                target=_generate_shard,
+                kwargs=dict(
+                    mode=self._mode,
+                    variant=self._variant,
+                    statements=self._statements.iloc[i::data_parallel_size],
+                    system_message=self._system_message,
+                    engine_factory=self._engine_factory,
+                    devices=devices[i],
+                    shard_file_path=shard_file_path,
+                    shard_id=i,
+                ),
+            )
+            process.start()
+            processes[i] = process
+            self._logger.debug(f"Started worker for shard {i} on devices {devices[i]}.")
+
+        failed_shard_ids = []
+        for i, process in processes.items():
+            process.join()
+            if process.exitcode == 0:
+                self._logger.info(f"Shard {i} completed.")
+            else:
+                failed_shard_ids.append(i)
+                self._logger.error(f"Shard {i} failed (exit code {process.exitcode}).")
+
+        if failed_shard_ids:
+            raise RuntimeError(
+                f"Datagen failed for shards {failed_shard_ids}. Completed shards are "
+                f"cached in '{shards_folder_path}'; re-run to retry the failed ones."
+            )
+
+        shards = [pd.read_parquet(p) for p in shard_file_paths]
+        answers = pd.concat(shards).loc[self._statements.index, self._column_names]
+        shutil.rmtree(shards_folder_path)
+        return answers
+
+    def generate(self):
+        self._logger.info("Generating answers...")
+        data_parallel_size = self._settings["datagen:data_parallel_size"]
+
+        if data_parallel_size > 1:
+            self._logger.info(
+                f"Sharding statements across {data_parallel_size} workers..."
+            )
+            self._answers = self._generate_data_parallel(data_parallel_size)
+        else:
+            self.generate_shard()
+
+        archive = AnswerArchive(mode=self._mode, variant=self._variant)
+        archive.write(split="training", model=MODEL_NAME, answers=self._answers)
+        self._logger.info(f"Answers generated and saved to '{archive.folder_path}'.")
         return self._answers
+
+
+def check_data_parallel(mode, num_statements, data_parallel_size):
+    """
+    Generate answers to made-up statements with `FakeEngine`, once on a single
+    engine and once across `data_parallel_size` worker processes, and check
+    that the merged answers are identical. Runs on CPU.
+    """
+
+    # Hide GPUs, so that the workers don't need any
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    statements = pd.Series(
+        [f"Statement number {i}." for i in range(1, num_statements + 1)],
+        index=range(1, num_statements + 1),
+    )
+    generator_kwargs = dict(
+        mode=mode,
+        statements=statements,
+        system_message="You are a test.",
+        engine_factory=FakeEngine,
+    )
+    single_engine = AnswerGenerator(**generator_kwargs)
+    if single_engine.shards_folder_path.exists():
+        raise RuntimeError(
+            f"'{single_engine.shards_folder_path}' holds the shards of an "
+            "interrupted datagen run. Finish or delete it first."
+        )
+    expected = single_engine.generate_shard()
+    data_parallel = AnswerGenerator(**generator_kwargs)
+    answers = data_parallel._generate_data_parallel(data_parallel_size)
+
+    assert answers.index.equals(expected.index)
+    assert list(answers.columns) == list(expected.columns)
+    assert (answers.values == expected.values).all()
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(
+        description="Check data-parallel datagen on CPU with a fake engine."
+    )
+    cli_parser.add_argument("-d", "--dev-mode", action="store_true")
+    cli_parser.add_argument("--num-statements", type=int, default=9)
+    cli_parser.add_argument("--data-parallel-size", type=int, default=2)
+    cli_args = cli_parser.parse_args()
+    mode = "dev" if cli_args.dev_mode else "standard"
+    configure_logger(logger_name="pipeline", log_level="info")
+
+    check_data_parallel(
+        mode=mode,
+        num_statements=cli_args.num_statements,
+        data_parallel_size=cli_args.data_parallel_size,
+    )
+    print("OK")
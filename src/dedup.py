@@ -0,0 +1,153 @@
+from itertools import combinations, groupby
+import logging
+import zlib
+import numpy as np
+import pandas as pd
+from transformers import AutoTokenizer
+
+from src.archive import AnswerArchive
+from src.config import PathProvider, SettingProvider
+from src.datagen import MODEL_NAME
+from src.throughput import ThroughputLog
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+class MinHash:
+    """
+    Finds near-duplicate texts via MinHash signatures, on CPU.
+
+    Texts are compared by the Jaccard similarity of their sets of word
+    `shingle_size`-grams, as estimated from their signatures. Since there are
+    only a few answers per statement, all pairs of signatures are compared;
+    pairs whose estimated similarity is at least `threshold` are duplicates.
+    """
+
+    def __init__(self, threshold, num_permutations=128, shingle_size=5, seed=0):
+        self._threshold = threshold
+        self._shingle_size = shingle_size
+        rng = np.random.default_rng(seed=seed)
+        size = num_permutations
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=size, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=size, dtype=np.uint64)
+
+    def _shingles(self, text):
+        words = text.split()
+        n = self._shingle_size
+        grams = [" ".join(words[i : i + n]) for i in range(max(1, len(words) - n + 1))]
+        return np.array(
+            [zlib.crc32(g.encode("utf-8")) for g in set(grams)], dtype=np.uint64
+        )
+
+    def signature(self, text):
+        shingles = self._shingles(text)
+        # Universal hashing: (a * x + b) mod p, for each permutation and shingle
+        hashes = (np.outer(shingles, self._a) + self._b) % _MERSENNE_PRIME
+        return (hashes & _MAX_HASH).min(axis=0)
+
+    def duplicates(self, texts):
+        """
+        Return, for each of the `texts`, the index of the first text it is a
+        near-duplicate of, or `None` if it is not a near-duplicate.
+        """
+
+        signatures = [self.signature(t) for t in texts]
+
+        # Union-find, so that each cluster is represented by its first text
+        parents = list(range(len(texts)))
+
+        def find(i):
+            while parents[i] != i:
+                i = parents[i]
+            return i
+
+        for i, j in combinations(range(len(texts)), 2):
+            similarity = np.mean(signatures[i] == signatures[j])
+            if similarity >= self._threshold:
+                root_i, root_j = find(i), find(j)
+                parents[max(root_i, root_j)] = min(root_i, root_j)
+
+        roots = [find(i) for i in range(len(texts))]
+        return [None if r == i else r for i, r in enumerate(roots)]
+
+
+class Deduplicator:
+    """
+    Drops near-duplicate answers to the same statement from the training data.
+
+    Saves a table of all training answers, with a flag `kept` and, for dropped
+    answers, the `sample` they duplicate, to `dedup.parquet` in the cache folder.
+    """
+
+    def __init__(self, mode, variant=None):
+        self._mode = mode
+        self._variant = variant
+        self._logger = logging.getLogger("pipeline")
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode, variant=variant)
+        self._archive = AnswerArchive(mode=mode, variant=variant)
+
+    @property
+    def file_path(self):
+        return self._paths.cache_folder_path / "dedup.parquet"
+
+    def deduplicate(self):
+        self._logger.info("Pruning near-duplicate answers...")
+        min_hash = MinHash(
+            threshold=self._settings["dedup:threshold"],
+            num_permutations=self._settings["dedup:num_permutations"],
+            shingle_size=self._settings["dedup:shingle_size"],
+        )
+        tokenizer = AutoTokenizer.from_pretrained(self._settings["model_id"])
+        rows = self._archive.iter_rows(
+            split="training",
+            model=MODEL_NAME,
+            columns=["statement_id", "sample", "text"],
+        )
+        records = []
+        removed_tokens = 0
+        total_tokens = 0
+
+        # Rows are sorted by statement
+        for statement_id, statement_rows in groupby(rows, lambda r: r["statement_id"]):
+            statement_rows = list(statement_rows)
+            texts = [r["text"] for r in statement_rows]
+            duplicate_of = min_hash.duplicates(texts)
+            for row, d in zip(statement_rows, duplicate_of):
+                duplicate_sample = None if d is None else statement_rows[d]["sample"]
+                token_ids = tokenizer.encode(row["text"], add_special_tokens=False)
+                num_tokens = len(token_ids)
+                total_tokens += num_tokens
+                if d is not None:
+                    removed_tokens += num_tokens
+                records.append(
+                    {
+                        "statement_id": statement_id,
+                        "sample": row["sample"],
+                        "kept": d is None,
+                        "duplicate_of": duplicate_sample,
+                    }
+                )
+
+        dedup = pd.DataFrame.from_records(records).astype({"duplicate_of": "Int32"})
+        dedup.to_parquet(self.file_path, index=False)
+        num_dropped = int((~dedup["kept"]).sum())
+        self._logger.info(
+            f"Dropped {num_dropped} of {len(dedup)} answers as near-duplicates, "
+            f"removing {removed_tokens} of {total_tokens} training tokens "
+            f"({removed_tokens / max(1, total_tokens):.1%})."
+        )
+        ThroughputLog(mode=self._mode, variant=self._variant).record(
+            "dedup:kept_fraction", 1 - num_dropped / len(dedup)
+        )
+
+    def kept_answers(self):
+        """
+        Return the set of `(statement_id, sample)` pairs that were kept.
+        """
+
+        columns = ["statement_id", "sample", "kept"]
+        dedup = pd.read_parquet(self.file_path, columns=columns)
+        dedup = dedup[dedup["kept"]]
+        return set(zip(dedup["statement_id"], dedup["sample"]))
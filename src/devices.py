@@ -0,0 +1,29 @@
+import os
+import torch
+
+
+def assign_devices(num_groups, group_size):
+    """
+    Split the visible CUDA devices into `num_groups` disjoint groups of
+    `group_size` devices each.
+
+    Returns a list with one list of device IDs (`str`) per group, or `None`
+    per group if no device is visible (e.g. when running on CPU).
+    """
+
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None:
+        devices = [d for d in visible_devices.split(",") if d]
+    else:
+        devices = [str(d) for d in range(torch.cuda.device_count())]
+
+    if not devices:
+        return [None] * num_groups
+
+    required = num_groups * group_size
+    if len(devices) < required:
+        raise RuntimeError(
+            f"Need {required} devices ({num_groups} x {group_size}), "
+            f"but only {len(devices)} are available."
+        )
+    return [devices[i * group_size : (i + 1) * group_size] for i in range(num_groups)]
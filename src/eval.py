@@ -1,10 +1,23 @@
 from dataclasses import dataclass
 from inspect_ai import eval
+from inspect_ai.log import read_eval_log
 from inspect_evals.ahb import ahb
 import logging
 import os
+from time import perf_counter
 
 from src.config import PathProvider, SettingProvider
+from src.grading import BatchGrader, GeminiBatchProvider
+from src.inprocess import InProcessEngine
+from src.router import AIMDLimiter, ThrottlingProxy
+from src.throughput import ThroughputLog
+
+# Environment variable for each grader provider's base URL, and the URL it defaults to
+_GRADER_ENDPOINTS = {
+    "google": ("GOOGLE_BASE_URL", "https://generativelanguage.googleapis.com"),
+    "openai": ("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+    "anthropic": ("ANTHROPIC_BASE_URL", "https://api.anthropic.com"),
+}
 
 
 @dataclass
@@ -15,54 +28,271 @@ class _EvalRun:
 
 
 class Evaluator:
-    def __init__(self, mode, server_host, server_port):
+    """
+    Runs AHB on the pre-distill model and all checkpoints.
+
+    The setting `eval:backend` selects how the solver models are run: via a
+    running `LLMServer` (`server`), or via an `InProcessEngine` (`in-process`).
+
+    The setting `eval:grading` selects how answers are graded: `sync` sends
+    each grader request right away; `batch` first runs all solvers, then
+    grades all answers via the grader provider's batch API (`batch_provider`,
+    by default Gemini's).
+
+    In a sweep, the "pre-distill" model is the same for all variants. Hence,
+    `scope` selects which models to evaluate: `all` of them, only the `shared`
+    one (i.e. the "pre-distill" model without system prompt), or only those
+    specific to the `variant`.
+    """
+
+    def __init__(
+        self,
+        mode,
+        server_host,
+        server_port,
+        batch_provider=None,
+        variant=None,
+        scope="all",
+    ):
         self._mode = mode
+        self._variant = variant
         self._logger = logging.getLogger("pipeline")
-        self._settings = SettingProvider(mode=mode)
-        self._paths = PathProvider(mode=mode)
-        self._vllm_base_url = f"http://{server_host}:{server_port}/v1"
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode, variant=variant)
+        self._scope = scope
+        self._backend = self._settings["eval:backend"]
+        self._grading = self._settings["eval:grading"]
+        self._batch_provider = batch_provider
+        self._server_host = server_host
+        self._server_url = f"http://{server_host}:{server_port}"
+        self._proxies = []
+        self._grader_limiters = []
+        self._overridden_env = {}
 
     def _get_eval_runs(self):
-        checkpoints_folder_path = self._paths.cache_folder_path / "checkpoints"
-        folder_entries = os.listdir(checkpoints_folder_path)
+        model_id = self._settings["model_id"]
+        if self._scope == "shared":
+            self._logger.info(
+                'Evaluating the "pre-distill" model (without system prompt)...'
+            )
+            return [_EvalRun("pre-distill", model_id=model_id)]
+
+        folder_entries = os.listdir(self._paths.checkpoints_folder_path)
         checkpoint_ids = sorted(
             [f for f in folder_entries if f.startswith("checkpoint-")]
         )
-        model_id = self._settings["model_id"]
         system_message = self._settings["system_message"]
         eval_runs = [
-            _EvalRun("pre-distill", model_id=model_id),
             _EvalRun(
                 "pre-distill-prompted", model_id=model_id, system_message=system_message
             ),
         ]
-        eval_runs.extend([_EvalRun(c, model_id=c) for c in checkpoint_ids])
+        eval_runs.extend(
+            [
+                _EvalRun(c, model_id=self._paths.checkpoint_model_id(c))
+                for c in checkpoint_ids
+            ]
+        )
+        if self._scope == "variant":
+            self._logger.info(
+                f'Evaluating the "pre-distill" model (with system prompt) '
+                f"and {len(checkpoint_ids)} checkpoints..."
+            )
+            return eval_runs
+
         self._logger.info(
             f'Evaluating the "pre-distill" model (with and without system prompt) '
             f"and {len(checkpoint_ids)} checkpoints..."
         )
-        return eval_runs
+        return [_EvalRun("pre-distill", model_id=model_id)] + eval_runs
+
+    def _override_env(self, name, value):
+        self._overridden_env.setdefault(name, os.environ.get(name))
+        os.environ[name] = value
+
+    def _start_proxy(self, role, name, upstream_url):
+        limiter = AIMDLimiter(
+            name=name,
+            initial_limit=self._settings[f"eval:{role}:initial_connections"],
+            max_limit=self._settings[f"eval:{role}:max_connections"],
+            target_latency=self._settings[f"eval:{role}:target_latency"],
+        )
+        proxy = ThrottlingProxy(
+            host=self._server_host, port=0, upstream_url=upstream_url, limiter=limiter
+        )
+        proxy.start()
+        self._proxies.append(proxy)
+        return proxy
+
+    def _start_proxies(self):
+        """
+        Route solver and grader traffic through separate throttling proxies,
+        so that each gets its own adaptive concurrency limit.
+        """
+
+        if self._backend == "server":
+            solver_proxy = self._start_proxy(
+                role="solver", name="solver", upstream_url=self._server_url
+            )
+            self._override_env("VLLM_BASE_URL", f"{solver_proxy.url}/v1")
+        if self._grading == "batch":
+            return
+
+        grader_refs = self._settings["grader_models:refs"]
+        grader_providers = {r.split("/")[0] for r in grader_refs}
+        for provider in sorted(grader_providers):
+            if provider not in _GRADER_ENDPOINTS:
+                self._logger.warning(
+                    f"Can't throttle grader provider '{provider}' adaptively."
+                )
+                continue
+            env_var, default_url = _GRADER_ENDPOINTS[provider]
+            upstream_url = os.environ.get(env_var, default_url)
+            grader_proxy = self._start_proxy(
+                role="grader", name=f"grader ({provider})", upstream_url=upstream_url
+            )
+            self._grader_limiters.append(grader_proxy.limiter)
+            self._override_env(env_var, grader_proxy.url)
+
+    def _stop_proxies(self):
+        for proxy in self._proxies:
+            proxy.stop()
+            self._logger.debug(
+                f"Final concurrency limit for {proxy.limiter.name}: "
+                f"{int(proxy.limiter.limit)}"
+            )
+        self._proxies = []
+        self._grader_limiters = []
+
+        for name, value in self._overridden_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self._overridden_env = {}
 
     def evaluate(self):
-        os.environ["VLLM_BASE_URL"] = self._vllm_base_url
         os.environ["VLLM_API_KEY"] = "none"  # Just to make the OpenAI client happy
         os.environ["INSPECT_LOG_LEVEL"] = self._settings["log_level"]
         os.environ["INSPECT_LOG_TRANSCRIPT"] = self._settings["log_level"]
+        # Upper bound only; the proxies adapt the actual concurrency
+        max_connections = max(
+            self._settings["eval:solver:max_connections"],
+            self._settings["eval:grader:max_connections"],
+        )
+        engine = None
+        if self._backend == "in-process":
+            engine = InProcessEngine(mode=self._mode)
+            engine.start()
+        self._start_proxies()
+
+        try:
+            self._run_evals(max_connections)
+        finally:
+            self._stop_proxies()
+            if engine is not None:
+                engine.stop()
+        self._logger.info("Evaluation completed.")
+
+    def _get_task(self):
+        grader_refs = self._settings["grader_models:refs"]
+        if self._grading == "batch":
+            grader_refs = [BatchGrader.model_ref(r) for r in grader_refs]
+        return ahb(
+            epochs=self._settings["eval:num_epochs"],
+            grader_models=grader_refs,
+            grader_temperature=self._settings["grader_models:temperature"],
+            grader_max_retries=self._settings["eval:max_retries"],
+            grader_max_tokens=self._settings["grader_models:max_tokens"],
+        )
+
+    def _record_throughput(self, duration, num_samples, dataset_size):
+        throughput_log = ThroughputLog(mode=self._mode, variant=self._variant)
+        throughput_log.record(
+            "eval:samples_per_s",
+            num_samples / duration,
+            num_replicas=self._settings["eval:num_replicas"],
+        )
+        throughput_log.record("eval:dataset_size", dataset_size)
+
+        limiters = self._grader_limiters
+        num_requests = sum(limiter.num_requests for limiter in limiters)
+        if num_requests > 0:
+            total_latency = sum(limiter.total_latency for limiter in limiters)
+            throughput_log.record("grader:latency_s", total_latency / num_requests)
+            throughput_log.record("grader:calls_per_sample", num_requests / num_samples)
+
+    def _find_completed_log(self, log_folder_path):
+        """
+        The log of a previous attempt at an eval run, if it succeeded (e.g.
+        before the eval stage failed at a later run).
+        """
+
+        log_file_paths = sorted(log_folder_path.glob("*.eval"))
+        if not log_file_paths:
+            return None
+        # Later stages use the latest log, so only that one counts
+        header = read_eval_log(log_file_paths[-1], header_only=True)
+        return log_file_paths[-1] if header.status == "success" else None
+
+    def _run_evals(self, max_connections):
+        provider = "vllm" if self._backend == "server" else "inprocess"
+        log_file_paths = []
+        num_samples = 0
+        dataset_size = None
+        start_time = perf_counter()
 
         for eval_run in self._get_eval_runs():
-            os.environ["INSPECT_LOG_DIR"] = str(
+            log_folder_path = (
                 self._paths.outputs_folder_path / "evals" / eval_run.run_id
             )
-            eval(
-                ahb(
-                    epochs=self._settings["eval:num_epochs"],
-                    grader_models=self._settings["grader_models:refs"],
-                    grader_temperature=self._settings["grader_models:temperature"],
-                    grader_max_retries=self._settings["eval:max_retries"],
-                    grader_max_tokens=self._settings["grader_models:max_tokens"],
-                ),
-                model=f"vllm/{eval_run.model_id}",
+            completed_log_file_path = self._find_completed_log(log_folder_path)
+            if completed_log_file_path is not None:
+                self._logger.info(f"Found completed eval run '{eval_run.run_id}'.")
+                log_file_paths.append(completed_log_file_path)
+                continue
+
+            os.environ["INSPECT_LOG_DIR"] = str(log_folder_path)
+            [log] = eval(
+                self._get_task(),
+                model=f"{provider}/{eval_run.model_id}",
                 system_message=eval_run.system_message,
-                max_connections=self._settings["eval:max_connections"],
+                max_connections=max_connections,
+                score=self._grading == "sync",
             )
-        self._logger.info("Evaluation completed.")
+            log_file_paths.append(log.location)
+            dataset_size = log.eval.dataset.samples
+            num_samples += dataset_size * log.eval.config.epochs
+
+        if self._grading == "batch":
+            self._grade_in_batch(log_file_paths)
+        # After batch grading, so that the samples/s include grading time
+        if num_samples > 0:
+            self._record_throughput(
+                duration=perf_counter() - start_time,
+                num_samples=num_samples,
+                dataset_size=dataset_size,
+            )
+
+    def _grade_in_batch(self, log_file_paths):
+        self._logger.info("Grading answers via batch API...")
+        grader_refs = self._settings["grader_models:refs"]
+        if self._batch_provider is None:
+            if any(not r.startswith("google/") for r in grader_refs):
+                raise ValueError("Batch grading supports only Gemini grader models.")
+            self._batch_provider = GeminiBatchProvider()
+
+        batch_grader = BatchGrader(
+            provider=self._batch_provider,
+            batch_folder_path=self._paths.outputs_folder_path / "grading-batches",
+            poll_interval=self._settings["eval:batch:poll_interval"],
+        )
+        logs = [read_eval_log(p) for p in log_file_paths]
+        # Logs that were merged before the eval stage failed are scored already
+        logs = [log for log in logs if not (log.results and log.results.scores)]
+        if not logs:
+            return
+        scorers = self._get_task().scorer
+        batch_grader.collect(logs, scorers)
+        batch_grader.submit()
+        batch_grader.merge(logs, scorers)
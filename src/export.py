@@ -0,0 +1,183 @@
+import argparse
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import shutil
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
+from safetensors.torch import save_file
+import torch
+
+from src.config import PathProvider, SettingProvider, configure_logger
+from src.server import LLMServer
+
+_ADAPTER_PREFIX = "base_model.model."
+
+
+class AdapterMerger:
+    """
+    Merges the LoRA adapter of a checkpoint into the base model's weights and
+    saves the result as a standalone model (e.g. `merged/checkpoint-0030` in
+    the cache folder), which `LLMServer` can serve without LoRA.
+
+    The checkpoint is selected by the setting `export:checkpoint` (by default,
+    the last one). The base model is processed one safetensors shard at a
+    time, on the device given by the setting `export:device`, so peak memory
+    stays at about one shard plus the adapter.
+    """
+
+    def __init__(self, mode, variant=None):
+        self._mode = mode
+        self._logger = logging.getLogger("pipeline")
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode, variant=variant)
+        self._device = self._settings["export:device"]
+
+    @property
+    def folder_path(self):
+        return self._paths.cache_folder_path / "merged"
+
+    def _get_checkpoint_id(self):
+        checkpoint_id = self._settings["export:checkpoint"]
+        if checkpoint_id is not None:
+            return checkpoint_id
+        if not self._paths.checkpoints_folder_path.is_dir():
+            return None
+        folder_entries = os.listdir(self._paths.checkpoints_folder_path)
+        checkpoint_ids = sorted(
+            [f for f in folder_entries if f.startswith("checkpoint-")]
+        )
+        return checkpoint_ids[-1] if checkpoint_ids else None
+
+    def merged_model_path(self):
+        """
+        The folder that `merge` saves the merged model to. Before SFT, the
+        latest checkpoint isn't known yet, so this is `merged/latest`, which
+        doesn't exist.
+        """
+
+        return self.folder_path / (self._get_checkpoint_id() or "latest")
+
+    def _load_adapter(self, adapter_folder_path):
+        """
+        Return a dict that maps the name of each adapted base weight to the
+        pair of LoRA matrices `(A, B)`, and the LoRA scaling factor.
+        """
+
+        with (adapter_folder_path / "adapter_config.json").open() as config_file:
+            adapter_config = json.load(config_file)
+        if adapter_config.get("rank_pattern") or adapter_config.get("alpha_pattern"):
+            raise ValueError("Can't merge adapters with per-module ranks or alphas.")
+        rank = adapter_config["r"]
+        alpha = adapter_config["lora_alpha"]
+        if adapter_config.get("use_rslora"):
+            scale = alpha / math.sqrt(rank)
+        else:
+            scale = alpha / rank
+
+        lora_weights = {}
+        adapter_file_path = adapter_folder_path / "adapter_model.safetensors"
+        with safe_open(adapter_file_path, framework="pt", device=self._device) as f:
+            for key in f.keys():
+                # E.g. `base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight`
+                name = key.removeprefix(_ADAPTER_PREFIX)
+                module_name, matrix, _ = name.rsplit(".", 2)
+                if matrix not in ["lora_A", "lora_B"]:
+                    raise ValueError(f"Can't merge adapter weight '{key}'.")
+                matrices = lora_weights.setdefault(f"{module_name}.weight", {})
+                matrices[matrix] = f.get_tensor(key)
+
+        adapter = {k: (w["lora_A"], w["lora_B"]) for k, w in lora_weights.items()}
+        return adapter, scale
+
+    def _merge_shard(self, shard_file_path, merged_shard_file_path, adapter, scale):
+        merged_weights = {}
+        merged = []
+        with safe_open(shard_file_path, framework="pt", device=self._device) as f:
+            metadata = f.metadata()
+            for key in f.keys():
+                weight = f.get_tensor(key)
+                if key in adapter:
+                    lora_a, lora_b = adapter[key]
+                    delta = scale * (lora_b.float() @ lora_a.float())
+                    weight = (weight.float() + delta).to(weight.dtype)
+                    merged.append(key)
+                merged_weights[key] = weight.contiguous().cpu()
+        save_file(merged_weights, merged_shard_file_path, metadata=metadata)
+        return merged
+
+    def merge(self):
+        checkpoint_id = self._get_checkpoint_id()
+        if checkpoint_id is None:
+            raise RuntimeError("SFT hasn't saved any checkpoint yet.")
+        self._logger.info(f"Merging the adapter of '{checkpoint_id}' into the model...")
+        base_model_path = Path(
+            snapshot_download(
+                self._settings["model_id"],
+                allow_patterns=["*.json", "*.safetensors", "*.txt", "*.jinja"],
+            )
+        )
+        adapter, scale = self._load_adapter(
+            self._paths.checkpoints_folder_path / checkpoint_id
+        )
+
+        merged_model_path = self.folder_path / checkpoint_id
+        merged_model_path.mkdir(parents=True)
+        shard_file_paths = sorted(base_model_path.glob("*.safetensors"))
+        for file_path in base_model_path.iterdir():
+            if file_path.is_file() and file_path not in shard_file_paths:
+                shutil.copy(file_path, merged_model_path / file_path.name)
+
+        unmerged = set(adapter)
+        for i, shard_file_path in enumerate(shard_file_paths):
+            merged = self._merge_shard(
+                shard_file_path,
+                merged_model_path / shard_file_path.name,
+                adapter,
+                scale,
+            )
+            unmerged.difference_update(merged)
+            self._logger.debug(
+                f"Merged {len(merged)} weights in shard {i + 1} of "
+                f"{len(shard_file_paths)}."
+            )
+            if self._device != "cpu":
+                torch.cuda.empty_cache()
+
+        if unmerged:
+            raise RuntimeError(
+                f"{len(unmerged)} adapter weights don't match any base weight, "
+                f"e.g. '{sorted(unmerged)[0]}'."
+            )
+        self._logger.info(f"Merged model saved to '{merged_model_path}'.")
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(description="Serve the merged model.")
+    cli_parser.add_argument("-d", "--dev-mode", action="store_true")
+    cli_parser.add_argument("--variant", help="Sweep variant")
+    cli_parser.add_argument("--port", type=int, default=8000)
+    cli_args = cli_parser.parse_args()
+    mode = "dev" if cli_args.dev_mode else "standard"
+    paths = PathProvider(mode=mode)
+    configure_logger(
+        logger_name="pipeline",
+        log_folder_path=paths.outputs_folder_path,
+        log_level="info",
+    )
+
+    merger = AdapterMerger(mode=mode, variant=cli_args.variant)
+    server = LLMServer(
+        mode=mode,
+        host="127.0.0.1",
+        port=cli_args.port,
+        model_path=merger.merged_model_path(),
+    )
+    server.start()
+    try:
+        server.wait_until_ready()
+        input("Press Enter to stop the server.\n")
+    finally:
+        server.stop()
@@ -0,0 +1,350 @@
+from collections import Counter
+import hashlib
+import json
+import logging
+from pathlib import Path
+import shutil
+from time import sleep
+from google import genai
+from inspect_ai import score
+from inspect_ai.log import EvalError, recompute_metrics, transcript, write_eval_log
+from inspect_ai.model import GenerateConfig, ModelAPI, ModelOutput, modelapi
+
+
+# Source of the transcript events that mark failed grader requests
+_ERROR_SOURCE = "batch_grader"
+
+
+class BatchProvider:
+    """
+    Interface to a grader provider's batch API.
+
+    A batch request file holds one JSON object per line, `{"key": ..., "request": ...}`,
+    where `request` is a Gemini `GenerateContentRequest`. A batch result file
+    holds one JSON object per line, `{"key": ..., "text": ...}`, or
+    `{"key": ..., "error": ...}` if the request failed.
+    """
+
+    def submit(self, model_name, request_file_path) -> str:
+        """
+        Submit the requests in `request_file_path` and return the batch's ID.
+        """
+
+        raise NotImplementedError()
+
+    def done(self, batch_id) -> bool:
+        """
+        Return `True` if the batch succeeded; raise a `RuntimeError` if it failed.
+        """
+
+        raise NotImplementedError()
+
+    def download(self, batch_id, result_file_path):
+        raise NotImplementedError()
+
+
+class GeminiBatchProvider(BatchProvider):
+    def __init__(self):
+        self._client = genai.Client()
+
+    def submit(self, model_name, request_file_path):
+        uploaded_file = self._client.files.upload(
+            file=str(request_file_path),
+            config={"display_name": request_file_path.name, "mime_type": "jsonl"},
+        )
+        batch = self._client.batches.create(
+            model=model_name,
+            src=uploaded_file.name,
+            config={"display_name": request_file_path.stem},
+        )
+        return batch.name
+
+    def done(self, batch_id):
+        batch = self._client.batches.get(name=batch_id)
+        state = batch.state.name
+        if state in ["JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"]:
+            raise RuntimeError(f"Batch '{batch_id}' ended in state {state}.")
+        return state == "JOB_STATE_SUCCEEDED"
+
+    def download(self, batch_id, result_file_path):
+        batch = self._client.batches.get(name=batch_id)
+        content = self._client.files.download(file=batch.dest.file_name)
+
+        with result_file_path.open("w") as result_file:
+            for line in content.decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                result_file.write(json.dumps(self._parse_result(result)))
+                result_file.write("\n")
+
+    @staticmethod
+    def _parse_result(result):
+        key = result["key"]
+        if "response" not in result:
+            return {"key": key, "error": str(result.get("error"))}
+        candidates = result["response"].get("candidates") or []
+        if len(candidates) != 1:
+            # E.g. the prompt was blocked
+            feedback = result["response"].get("promptFeedback")
+            return {"key": key, "error": f"{len(candidates)} candidates ({feedback})"}
+        parts = candidates[0].get("content", {}).get("parts", [])
+        # Skip thought summaries, if any
+        text = "".join(p["text"] for p in parts if not p.get("thought"))
+        return {"key": key, "text": text}
+
+
+class LocalBatchProvider(BatchProvider):
+    """
+    A stand-in for a batch API that answers requests locally.
+
+    Submitted request files are copied to `folder_path`. Each request is
+    answered by `respond`, which maps the request's prompt (`str`) to a
+    response (`str`).
+    """
+
+    def __init__(self, folder_path, respond):
+        self._folder_path = Path(folder_path)
+        self._respond = respond
+
+    def submit(self, model_name, request_file_path):
+        batch_id = f"{len(list(self._folder_path.glob('*.jsonl'))):03d}"
+        self._folder_path.mkdir(parents=True, exist_ok=True)
+        shutil.copy(request_file_path, self._folder_path / f"{batch_id}.jsonl")
+        return batch_id
+
+    def done(self, batch_id):
+        return True
+
+    def download(self, batch_id, result_file_path):
+        request_file_path = self._folder_path / f"{batch_id}.jsonl"
+
+        with (
+            request_file_path.open() as request_file,
+            result_file_path.open("w") as result_file,
+        ):
+            for line in request_file:
+                request = json.loads(line)
+                prompt = "\n\n".join(
+                    p["text"]
+                    for c in request["request"]["contents"]
+                    for p in c["parts"]
+                )
+                text = self._respond(prompt)
+                result_file.write(json.dumps({"key": request["key"], "text": text}))
+                result_file.write("\n")
+
+
+class _BatchGraderState:
+    """
+    Shared between `BatchGrader` and the `_BatchGraderAPI` instances that
+    inspect creates for the grader models.
+
+    In `collect` mode, grader requests are recorded and answered with a
+    placeholder. In `replay` mode, they are answered with the batch results;
+    requests that failed are answered with an empty text, and marked in the
+    sample's transcript.
+    """
+
+    mode = None
+    requests = {}  # Model name -> key -> request
+    results = {}  # Key -> text
+    errors = {}  # Key -> error message
+    _occurrences = Counter()
+
+    @classmethod
+    def reset(cls, mode):
+        cls.mode = mode
+        cls._occurrences = Counter()
+
+    @classmethod
+    def key(cls, model_name, request):
+        # Identical requests (e.g. repeated grader samples) get distinct keys
+        content = json.dumps([model_name, request], sort_keys=True)
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+        cls._occurrences[digest] += 1
+        return f"{digest}-{cls._occurrences[digest]}"
+
+
+def _to_gemini_request(messages, config):
+    request = {"contents": []}
+    for message in messages:
+        if message.role == "system":
+            request["system_instruction"] = {"parts": [{"text": message.text}]}
+        else:
+            role = "model" if message.role == "assistant" else "user"
+            content = {"role": role, "parts": [{"text": message.text}]}
+            request["contents"].append(content)
+
+    generation_config = {}
+    if config.temperature is not None:
+        generation_config["temperature"] = config.temperature
+    if config.max_tokens is not None:
+        generation_config["maxOutputTokens"] = config.max_tokens
+    if generation_config:
+        request["generation_config"] = generation_config
+    return request
+
+
+class _BatchGraderAPI(ModelAPI):
+    def __init__(
+        self,
+        model_name,
+        base_url=None,
+        api_key=None,
+        config=GenerateConfig(),
+        **model_args,
+    ):
+        super().__init__(model_name, base_url, api_key, [], config)
+
+    async def generate(self, input, tools, tool_choice, config):
+        request = _to_gemini_request(input, config)
+        key = _BatchGraderState.key(self.model_name, request)
+
+        if _BatchGraderState.mode == "collect":
+            _BatchGraderState.requests.setdefault(self.model_name, {})[key] = request
+            return ModelOutput.from_content(model=self.model_name, content="")
+
+        if key not in _BatchGraderState.results:
+            error = _BatchGraderState.errors.get(key, "no batch result")
+            transcript().info({"key": key, "error": error}, source=_ERROR_SOURCE)
+            return ModelOutput.from_content(
+                model=self.model_name, content="", error=error
+            )
+        return ModelOutput.from_content(
+            model=self.model_name, content=_BatchGraderState.results[key]
+        )
+
+
+@modelapi(name="batch")
+def batch_grader():
+    return _BatchGraderAPI
+
+
+class BatchGrader:
+    """
+    Grades unscored eval logs through a batch API instead of synchronous calls.
+
+    1. `collect`: Score each log with `scorers`, recording (not sending) the
+       grader requests.
+    2. `submit`: Write one batch request file per grader model and submit it.
+    3. `merge`: Poll until all batches are done, then score each log again,
+       answering the grader requests from the batch results, and save the logs.
+       Samples with failed grader requests get an error instead of a score.
+    """
+
+    def __init__(self, provider, batch_folder_path, poll_interval=60):
+        self._logger = logging.getLogger("pipeline")
+        self._provider = provider
+        self._batch_folder_path = batch_folder_path
+        self._poll_interval = poll_interval
+        self._batch_ids = {}
+
+    @staticmethod
+    def model_ref(grader_model_ref):
+        """
+        The model ref that makes inspect route grader requests through this class.
+        """
+
+        return f"batch/{grader_model_ref}"
+
+    def collect(self, logs, scorers):
+        _BatchGraderState.reset(mode="collect")
+        _BatchGraderState.requests = {}
+        for log in logs:
+            score(log, scorers, action="overwrite")
+        num_requests = sum(len(r) for r in _BatchGraderState.requests.values())
+        self._logger.info(
+            f"Collected {num_requests} grader requests from {len(logs)} eval logs."
+        )
+
+    def submit(self):
+        self._batch_folder_path.mkdir(parents=True, exist_ok=True)
+        for model_name, requests in _BatchGraderState.requests.items():
+            # Gemini batch models are addressed without the provider prefix
+            provider_model_name = model_name.split("/", 1)[-1]
+            request_file_path = (
+                self._batch_folder_path
+                / f"requests-{provider_model_name.replace('/', '-')}.jsonl"
+            )
+            with request_file_path.open("w") as request_file:
+                for key, request in requests.items():
+                    request_file.write(json.dumps({"key": key, "request": request}))
+                    request_file.write("\n")
+            batch_id = self._provider.submit(provider_model_name, request_file_path)
+            self._batch_ids[model_name] = batch_id
+            self._logger.info(
+                f"Submitted {len(requests)} grader requests for '{model_name}' "
+                f"as batch '{batch_id}'."
+            )
+
+    def _wait(self):
+        pending = set(self._batch_ids.values())
+        while pending:
+            pending = {b for b in pending if not self._provider.done(b)}
+            if pending:
+                self._logger.debug(f"Waiting for {len(pending)} batches...")
+                sleep(self._poll_interval)
+
+    def merge(self, logs, scorers):
+        self._wait()
+        _BatchGraderState.results = {}
+        _BatchGraderState.errors = {}
+        for model_name, batch_id in self._batch_ids.items():
+            result_file_path = (
+                self._batch_folder_path / f"results-{batch_id.replace('/', '-')}.jsonl"
+            )
+            self._provider.download(batch_id, result_file_path)
+            with result_file_path.open() as result_file:
+                for line in result_file:
+                    result = json.loads(line)
+                    if "error" in result:
+                        _BatchGraderState.errors[result["key"]] = result["error"]
+                    else:
+                        _BatchGraderState.results[result["key"]] = result["text"]
+        self._logger.info(f"Downloaded {len(_BatchGraderState.results)} batch results.")
+        if _BatchGraderState.errors:
+            key, error = next(iter(_BatchGraderState.errors.items()))
+            self._logger.warning(
+                f"{len(_BatchGraderState.errors)} grader requests failed, e.g. "
+                f"'{key}': {error}"
+            )
+
+        _BatchGraderState.reset(mode="replay")
+        num_failed_samples = 0
+        for log in logs:
+            scored_log = score(log, scorers, action="overwrite")
+            num_failed_samples += self._fail_ungraded_samples(scored_log)
+            write_eval_log(scored_log)
+        self._logger.info(f"Merged batch results into {len(logs)} eval logs.")
+        if num_failed_samples > 0:
+            self._logger.warning(
+                f"{num_failed_samples} samples could not be graded and are marked "
+                "as errors."
+            )
+
+    def _fail_ungraded_samples(self, log):
+        """
+        Replace the scores of samples with failed grader requests by an error.
+        Returns the number of such samples.
+        """
+
+        num_failed_samples = 0
+        for sample in log.samples:
+            errors = [
+                e.data["error"]
+                for e in sample.events
+                if e.event == "info" and e.source == _ERROR_SOURCE
+            ]
+            if not errors:
+                continue
+            sample.scores = None
+            sample.error = EvalError(
+                message=f"{len(errors)} grader requests failed: {errors[0]}",
+                traceback="",
+                traceback_ansi="",
+            )
+            num_failed_samples += 1
+        if num_failed_samples > 0:
+            recompute_metrics(log)
+        return num_failed_samples
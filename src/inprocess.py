@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import threading
+from uuid import uuid4
+from inspect_ai.model import (
+    ChatCompletionChoice,
+    ChatMessageAssistant,
+    GenerateConfig,
+    ModelAPI,
+    ModelOutput,
+    ModelUsage,
+    modelapi,
+)
+from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+from vllm.lora.request import LoRARequest
+
+from src.config import PathProvider, SettingProvider
+
+
+class InProcessEngine:
+    """
+    A vLLM engine that runs in this process (in a background thread with its
+    own event loop), as an alternative to `LLMServer`.
+
+    Requests for a checkpoint (e.g. `checkpoint-0030`) are served by the base
+    model with that checkpoint's LoRA adapter; requests for the base model's
+    ID are served without adapter.
+    """
+
+    # The engine that `_InProcessAPI` uses
+    current = None
+
+    def __init__(self, mode):
+        self._mode = mode
+        self._logger = logging.getLogger("pipeline")
+        self._settings = SettingProvider(mode=mode)
+        self._paths = PathProvider(mode=mode)
+        self._engine = None
+        self._default_sampling_params = None
+        self._lora_ids = {}
+        self._loop = None
+        self._thread = None
+
+    async def _create_engine(self):
+        engine_args = AsyncEngineArgs(
+            model=self._settings["model_id"],
+            tensor_parallel_size=self._settings["tensor_parallel_size"],
+            max_model_len=self._settings["max_model_len"],
+            gpu_memory_utilization=self._settings["eval:gpu_memory_utilization"],
+            enable_lora=True,
+            max_lora_rank=self._settings["lora_rank"],
+        )
+        self._engine = AsyncLLMEngine.from_engine_args(engine_args)
+        # Like `vllm serve`, default to the model's generation config
+        self._default_sampling_params = (
+            self._engine.model_config.get_diff_sampling_param()
+        )
+
+    def start(self):
+        self._logger.info("Starting in-process engine...")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._create_engine(), self._loop).result()
+        InProcessEngine.current = self
+        self._logger.info("In-process engine started.")
+
+    def stop(self):
+        if self._loop is None:
+            return
+        self._engine.shutdown()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+        InProcessEngine.current = None
+        self._logger.info("In-process engine stopped.")
+
+    def _get_lora_request(self, model_id):
+        if model_id == self._settings["model_id"]:
+            return None
+        if model_id not in self._lora_ids:
+            self._lora_ids[model_id] = len(self._lora_ids) + 1
+        # Model IDs of checkpoints are paths relative to the shared cache folder
+        lora_path = self._paths.shared_cache_folder_path / model_id
+        return LoRARequest(model_id, self._lora_ids[model_id], str(lora_path))
+
+    def _get_sampling_params(self, config):
+        params = dict(self._default_sampling_params)
+        params["max_tokens"] = max(  # Reserve space for prompt
+            100, self._settings["max_model_len"] - 512
+        )
+        overrides = {
+            "temperature": config.temperature,
+            "top_p": config.top_p,
+            "top_k": config.top_k,
+            "max_tokens": config.max_tokens,
+            "seed": config.seed,
+            "stop": config.stop_seqs,
+        }
+        params.update({k: v for k, v in overrides.items() if v is not None})
+        return SamplingParams(**params)
+
+    async def _generate(self, model_id, messages, config):
+        tokenizer = await self._engine.get_tokenizer()
+        prompt = tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+        final_output = None
+        async for output in self._engine.generate(
+            prompt,
+            self._get_sampling_params(config),
+            request_id=str(uuid4()),
+            lora_request=self._get_lora_request(model_id),
+        ):
+            final_output = output
+        return final_output
+
+    async def generate(self, model_id, messages, config):
+        """
+        Generate a response in the engine's event loop, and await it from the
+        caller's event loop.
+        """
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._generate(model_id, messages, config), self._loop
+        )
+        return await asyncio.wrap_future(future)
+
+
+class _InProcessAPI(ModelAPI):
+    def __init__(
+        self,
+        model_name,
+        base_url=None,
+        api_key=None,
+        config=GenerateConfig(),
+        **model_args,
+    ):
+        super().__init__(model_name, base_url, api_key, [], config)
+
+    async def generate(self, input, tools, tool_choice, config):
+        engine = InProcessEngine.current
+        if engine is None:
+            raise RuntimeError("The in-process engine is not running.")
+
+        messages = [{"role": m.role, "content": m.text} for m in input]
+        output = await engine.generate(self.model_name, messages, config)
+        [completion] = output.outputs
+        stop_reason = "max_tokens" if completion.finish_reason == "length" else "stop"
+        input_tokens = len(output.prompt_token_ids)
+        output_tokens = len(completion.token_ids)
+        return ModelOutput(
+            model=self.model_name,
+            choices=[
+                ChatCompletionChoice(
+                    message=ChatMessageAssistant(
+                        content=completion.text,
+                        model=self.model_name,
+                        source="generate",
+                    ),
+                    stop_reason=stop_reason,
+                )
+            ],
+            usage=ModelUsage(
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                total_tokens=input_tokens + output_tokens,
+            ),
+        )
+
+
+@modelapi(name="inprocess")
+def in_process():
+    return _InProcessAPI
@@ -0,0 +1,172 @@
+import argparse
+from datetime import datetime
+import json
+import math
+from pathlib import Path
+from time import sleep
+import zipfile
+
+from src.config import PathProvider
+from src.stats import RunningMean
+
+_SUMMARIES_JOURNAL_PREFIX = "_journal/summaries/"
+_START_JOURNAL_NAME = "_journal/start.json"
+_HEADER_NAME = "header.json"
+
+
+class _RunState:
+    """
+    What is known about an eval run, from the journal entries of its log that
+    were read so far.
+    """
+
+    def __init__(self, eval_file_path):
+        self.eval_file_path = eval_file_path
+        self.status = "started"
+        self.num_samples = None  # Including epochs
+        self.scores = {}  # By `(sample ID, epoch)`
+        self.errors = set()  # `(sample ID, epoch)` of failed samples
+        self.stats = RunningMean()
+        self._read_entry_names = set()
+        self._modified_at = None
+
+    def _add_summary(self, summary):
+        key = (summary["id"], summary["epoch"])
+        if key in self.scores:  # E.g. re-scored
+            self.stats.remove(self.scores.pop(key))
+        self.errors.discard(key)
+
+        if summary.get("error"):
+            self.errors.add(key)
+            return
+        scores = summary.get("scores") or {}
+        if "ahb_scorer" not in scores:  # Not graded (yet)
+            return
+        score = float(scores["ahb_scorer"]["value"]["overall"])
+        self.scores[key] = score
+        self.stats.add(score)
+
+    def update(self):
+        """
+        Read the journal entries that were added to the log since the last
+        update. Returns whether the log could be read.
+        """
+
+        modified_at = self.eval_file_path.stat().st_mtime
+        if modified_at == self._modified_at:
+            return True
+
+        try:
+            with zipfile.ZipFile(self.eval_file_path) as log:
+                names = set(log.namelist())
+                if self.num_samples is None and _START_JOURNAL_NAME in names:
+                    spec = json.loads(log.read(_START_JOURNAL_NAME))["eval"]
+                    self.num_samples = (
+                        spec["dataset"]["samples"] * spec["config"]["epochs"]
+                    )
+                    self.status = "running"
+
+                new_entry_names = sorted(
+                    (
+                        n
+                        for n in names - self._read_entry_names
+                        if n.startswith(_SUMMARIES_JOURNAL_PREFIX)
+                    ),
+                    key=lambda n: int(Path(n).stem),
+                )
+                for name in new_entry_names:
+                    for summary in json.loads(log.read(name)):
+                        self._add_summary(summary)
+                    self._read_entry_names.add(name)
+
+                if _HEADER_NAME in names:
+                    self.status = json.loads(log.read(_HEADER_NAME))["status"]
+        except (zipfile.BadZipFile, KeyError, ValueError, OSError):
+            # The log is being written; try again on the next update
+            return False
+
+        self._modified_at = modified_at
+        return True
+
+
+class EvalMonitor:
+    """
+    Tracks the scores of the eval runs in `evals_folder_path` (one subfolder
+    per run) while they are in progress.
+
+    Each update only reads the log entries that were added since the last
+    one, and the running means and confidence intervals are updated online.
+    Note that these CIs treat all scored samples as i.i.d.; the final CIs by
+    `summarize_evals` are over the means per epoch instead.
+    """
+
+    def __init__(self, evals_folder_path, alpha=0.05):
+        self._evals_folder_path = evals_folder_path
+        self._alpha = alpha
+        self._runs = {}
+
+    def update(self):
+        if not self._evals_folder_path.is_dir():
+            return
+        for run_folder_path in sorted(self._evals_folder_path.iterdir()):
+            eval_file_paths = sorted(run_folder_path.glob("*.eval"))
+            if not eval_file_paths:
+                continue
+            # Follow the latest log if the run was repeated
+            run = self._runs.get(run_folder_path.name)
+            if run is None or run.eval_file_path != eval_file_paths[-1]:
+                run = _RunState(eval_file_paths[-1])
+                self._runs[run_folder_path.name] = run
+            run.update()
+
+    def describe(self):
+        lines = [
+            f"{'Run':22} | {'Status':9} | {'Samples':>11} | {'Errors':>6} | "
+            f"{'Mean':>6} | {'Margin':>6}"
+        ]
+        for run_id, run in self._runs.items():
+            ci = run.stats.ci(alpha=self._alpha)
+            num_samples = "?" if run.num_samples is None else run.num_samples
+            progress = f"{run.stats.n}/{num_samples}"
+            mean = "-" if math.isnan(ci.mean) else f"{ci.mean:6.3f}"
+            margin = "-" if math.isnan(ci.margin) else f"{ci.margin:6.3f}"
+            lines.append(
+                f"{run_id:22} | {run.status:9} | {progress:>11} | "
+                f"{len(run.errors):>6} | {mean:>6} | {margin:>6}"
+            )
+        return "\n".join(lines)
+
+    def watch(self, interval):
+        """
+        Print the table of runs every `interval` seconds, until interrupted.
+        """
+
+        try:
+            while True:
+                self.update()
+                print(f"{datetime.now():%H:%M:%S}\n{self.describe()}\n", flush=True)
+                sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(description="Monitor eval runs live.")
+    cli_parser.add_argument("-d", "--dev-mode", action="store_true")
+    cli_parser.add_argument("--variant", help="Sweep variant")
+    cli_parser.add_argument(
+        "--interval", type=int, default=30, help="Seconds between updates"
+    )
+    cli_parser.add_argument(
+        "--once", action="store_true", help="Print the table once, then exit"
+    )
+    cli_args = cli_parser.parse_args()
+    mode = "dev" if cli_args.dev_mode else "standard"
+    paths = PathProvider(mode=mode, variant=cli_args.variant)
+
+    monitor = EvalMonitor(paths.outputs_folder_path / "evals")
+    if cli_args.once:
+        monitor.update()
+        print(monitor.describe())
+    else:
+        monitor.watch(interval=cli_args.interval)
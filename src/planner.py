@@ -0,0 +1,230 @@
+import argparse
+from dataclasses import dataclass
+import math
+
+from src.config import PathProvider, SettingProvider
+from src.speciesismbench import StatementsLoader
+from src.throughput import ThroughputLog
+
+
+@dataclass
+class _Estimate:
+    stage: str
+    wall_clock: float | None  # In seconds; `None` if unknown
+    gpu_time: float | None  # In GPU seconds
+    grader_calls: float | None
+    basis: str
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "?"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+class Planner:
+    """
+    Estimates the wall clock time, GPU time, and grader calls of a pipeline
+    run (or sweep) with the current settings, without loading any model.
+
+    The estimates combine the settings and the size of SpeciesismBench with
+    the throughput numbers that previous runs recorded in the `ThroughputLog`
+    (for the same model and the settings each number depends on). Stages
+    without recorded numbers are estimated as unknown (`?`).
+    """
+
+    def __init__(self, mode, sweep=False):
+        self._mode = mode
+        self._settings = SettingProvider(mode=mode)
+        self._paths = PathProvider(mode=mode)
+        self._variants = list(self._settings["sweep:variants"]) if sweep else [None]
+        self._variant_settings = {
+            v: SettingProvider(mode=mode, variant=v) for v in self._variants + [None]
+        }
+        self._throughput_logs = {
+            v: ThroughputLog(mode=mode, variant=v) for v in self._variants + [None]
+        }
+
+    def _latest(self, variant, metric):
+        record = self._throughput_logs[variant].latest(metric)
+        return None if record is None else record["value"]
+
+    def _estimate_datagen(self, variant, num_statements):
+        settings = self._variant_settings[variant]
+        tensor_parallel_size = settings["tensor_parallel_size"]
+        data_parallel_size = settings["datagen:data_parallel_size"]
+        num_answers = num_statements * settings["datagen:answers_per_question"]
+        tokens_per_s = self._latest(variant, "datagen:tokens_per_s")  # Per engine
+        tokens_per_answer = self._latest(variant, "datagen:tokens_per_answer")
+        if tokens_per_s is None or tokens_per_answer is None:
+            return _Estimate("datagen", None, None, None, "no recorded throughput")
+
+        # Answers can't be longer than the generation limit
+        max_tokens = max(100, settings["max_model_len"] - 512)
+        tokens_per_answer = min(tokens_per_answer, max_tokens)
+        wall_clock = (
+            num_answers * tokens_per_answer / (tokens_per_s * data_parallel_size)
+        )
+        return _Estimate(
+            "datagen",
+            wall_clock,
+            wall_clock * data_parallel_size * tensor_parallel_size,
+            0,
+            f"{num_answers} answers x {tokens_per_answer:.0f} tokens "
+            f"at {tokens_per_s:.0f} tokens/s per engine",
+        )
+
+    def _estimate_num_sft_steps(self, variant, num_statements):
+        settings = self._variant_settings[variant]
+        num_answers = num_statements * settings["datagen:answers_per_question"]
+        kept_fraction = self._latest(variant, "dedup:kept_fraction")
+        num_examples = num_answers * (1 if kept_fraction is None else kept_fraction)
+        examples_per_step = self._latest(variant, "sft:examples_per_step")
+        if examples_per_step is None:
+            # Without packing, each step takes one batch of examples
+            examples_per_step = (
+                settings["sft:per_device_train_batch_size"]
+                * settings["sft:gradient_accumulation_steps"]
+            )
+        return math.ceil(num_examples * settings["sft:num_epochs"] / examples_per_step)
+
+    def _estimate_sft(self, variant, num_steps):
+        steps_per_s = self._latest(variant, "sft:steps_per_s")
+        if steps_per_s is None:
+            return _Estimate("sft", None, None, None, "no recorded throughput")
+        wall_clock = num_steps / steps_per_s
+        return _Estimate(
+            "sft",
+            wall_clock,
+            wall_clock,
+            0,
+            f"{num_steps} steps at {steps_per_s:.2f} steps/s",
+        )
+
+    def _estimate_eval(self, variant, num_runs):
+        settings = self._variant_settings[variant]
+        dataset_size = self._latest(variant, "eval:dataset_size")
+        samples_per_s_record = self._throughput_logs[variant].latest(
+            "eval:samples_per_s"
+        )
+        if dataset_size is None or samples_per_s_record is None:
+            return _Estimate("eval", None, None, None, "no recorded throughput")
+
+        num_samples = num_runs * dataset_size * settings["eval:num_epochs"]
+        num_replicas = settings["eval:num_replicas"]
+        samples_per_s = (
+            samples_per_s_record["value"]
+            / samples_per_s_record.get("num_replicas", 1)
+            * num_replicas
+        )
+        wall_clock = num_samples / samples_per_s
+        basis = (
+            f"{num_runs} runs x {dataset_size} samples x "
+            f"{settings['eval:num_epochs']} epochs at {samples_per_s:.2f} samples/s"
+        )
+
+        num_graders = len(settings["grader_models:refs"])
+        calls_per_sample = self._latest(variant, "grader:calls_per_sample")
+        grader_calls = num_samples * (calls_per_sample or num_graders)
+        grader_latency = self._latest(variant, "grader:latency_s")
+        if settings["eval:grading"] == "sync" and grader_latency is not None:
+            # More replicas don't help if the graders are the bottleneck
+            max_connections = settings["eval:grader:max_connections"]
+            grader_wall_clock = grader_calls * grader_latency / max_connections
+            wall_clock = max(wall_clock, grader_wall_clock)
+            basis += (
+                f"; {grader_latency:.1f}s per grader call "
+                f"over {max_connections} connections"
+            )
+        gpu_time = wall_clock * num_replicas * settings["tensor_parallel_size"]
+        return _Estimate("eval", wall_clock, gpu_time, grader_calls, basis)
+
+    def _sum(self, stage, estimates, basis):
+        if len(estimates) == 1:
+            return estimates[0]
+        if any(e.wall_clock is None for e in estimates):
+            return _Estimate(stage, None, None, None, "no recorded throughput")
+        return _Estimate(
+            stage,
+            sum(e.wall_clock for e in estimates),
+            sum(e.gpu_time for e in estimates),
+            sum(e.grader_calls for e in estimates),
+            basis,
+        )
+
+    def estimate(self):
+        statements_file_path = self._paths.cache_folder_path / "speciesismbench.csv"
+        if not statements_file_path.is_file():
+            raise RuntimeError(
+                "SpeciesismBench is not downloaded yet. Run the pipeline's `load` "
+                "stage first: `python -m pipeline --to load`."
+            )
+        statements = StatementsLoader(mode=self._mode).load(split="training")
+        num_variants = len(self._variants)
+        datagen_estimates = []
+        sft_estimates = []
+        num_checkpoints = {}
+        for variant in self._variants:
+            num_steps = self._estimate_num_sft_steps(variant, len(statements))
+            save_interval = self._variant_settings[variant]["sft:save_interval"]
+            # The trainer also saves a checkpoint after the last step
+            num_checkpoints[variant] = math.ceil(num_steps / save_interval)
+            datagen_estimates.append(self._estimate_datagen(variant, len(statements)))
+            sft_estimates.append(self._estimate_sft(variant, num_steps))
+
+        if self._variants == [None]:
+            eval_estimates = [self._estimate_eval(None, 2 + num_checkpoints[None])]
+        else:
+            # The "pre-distill" model without system prompt is shared by all variants
+            eval_estimates = [self._estimate_eval(None, 1)] + [
+                self._estimate_eval(v, 1 + num_checkpoints[v]) for v in self._variants
+            ]
+        estimates = [
+            self._sum("datagen", datagen_estimates, f"{num_variants} variants"),
+            self._sum("sft", sft_estimates, f"{num_variants} variants"),
+            self._sum(
+                "eval", eval_estimates, f"shared runs and {num_variants} variants"
+            ),
+        ]
+
+        known = [e for e in estimates if e.wall_clock is not None]
+        checkpoints = ", ".join(str(n) for n in num_checkpoints.values())
+        total = _Estimate(
+            "total",
+            sum(e.wall_clock for e in known),
+            sum(e.gpu_time for e in known),
+            sum(e.grader_calls for e in known),
+            f"{checkpoints} checkpoints per variant"
+            + ("" if len(known) == len(estimates) else "; excluding unknown stages"),
+        )
+        return estimates + [total]
+
+    def describe(self, estimates):
+        lines = [
+            f"{'Stage':7} | {'Wall clock':>10} | {'GPU time':>9} | "
+            f"{'Grader calls':>12} | Based on"
+        ]
+        for e in estimates:
+            grader_calls = "?" if e.grader_calls is None else f"{e.grader_calls:.0f}"
+            lines.append(
+                f"{e.stage:7} | {_format_duration(e.wall_clock):>10} | "
+                f"{_format_duration(e.gpu_time):>9} | {grader_calls:>12} | {e.basis}"
+            )
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(
+        description="Estimate the duration and costs of a pipeline run."
+    )
+    cli_parser.add_argument("-d", "--dev-mode", action="store_true")
+    cli_parser.add_argument(
+        "--sweep", action="store_true", help="Estimate a sweep over all variants"
+    )
+    cli_args = cli_parser.parse_args()
+
+    mode = "dev" if cli_args.dev_mode else "standard"
+    planner = Planner(mode=mode, sweep=cli_args.sweep)
+    print(planner.describe(planner.estimate()))
@@ -0,0 +1,23 @@
+THINK_START = "<think>"
+THINK_END = "</think>"
+
+
+def split_reasoning(text):
+    """
+    Split a Qwen3 answer into its reasoning (the content of the `<think>`
+    block) and its final answer. The reasoning is `""` if there is none.
+    """
+
+    if THINK_END not in text:
+        return "", text
+    reasoning, answer = text.split(THINK_END, 1)
+    reasoning = reasoning.split(THINK_START, 1)[-1]
+    return reasoning.strip("\n"), answer.lstrip("\n")
+
+
+def join_reasoning(reasoning, answer):
+    """
+    The inverse of `split_reasoning`, formatted like Qwen3's chat template.
+    """
+
+    return f"{THINK_START}\n{reasoning}\n{THINK_END}\n\n{answer}"
@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+from collections import Counter
+import json
+import logging
+import threading
+from time import monotonic
+from aiohttp import ClientConnectionResetError, ClientSession, ClientTimeout, web
+
+
+class _Proxy:
+    """
+    Base class for HTTP proxies that serve from a background thread, so that
+    they can be started and stopped from synchronous code.
+    """
+
+    def __init__(self, host, port):
+        self._logger = logging.getLogger("pipeline")
+        self._host = host
+        self.port = port  # If 0, a free port is chosen on start
+        self._loop = None
+        self._thread = None
+        self._runner = None
+        self._session = None
+
+    async def _handle(self, request):
+        raise NotImplementedError()
+
+    async def _forward(self, request, body, url):
+        headers = {
+            k: v
+            for k, v in request.headers.items()
+            if k.lower() not in ["host", "content-length"]
+        }
+        async with self._session.request(
+            request.method, url, data=body, headers=headers
+        ) as upstream:
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={
+                    k: v
+                    for k, v in upstream.headers.items()
+                    if k.lower()
+                    not in [
+                        "content-length",
+                        "content-encoding",
+                        "transfer-encoding",
+                        "connection",
+                    ]
+                },
+            )
+            try:
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+            except ClientConnectionResetError:
+                # E.g. the client timed out; the caller still releases its slot
+                self._logger.debug(
+                    f"Client disconnected during response to {request.rel_url.path}."
+                )
+            return response
+
+    async def _start(self):
+        self._session = ClientSession(timeout=ClientTimeout(total=None))
+        app = web.Application(client_max_size=0)
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def _stop(self):
+        await self._runner.cleanup()
+        await self._session.close()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+
+class Router(_Proxy):
+    """
+    A minimal HTTP proxy that spreads OpenAI-compatible requests across
+    several vLLM server replicas.
+
+    Each request goes to the replica with the fewest outstanding requests.
+    Requests for a LoRA adapter (i.e. the request's `model`) prefer replicas
+    that have already served that adapter, as long as they are not more than
+    `affinity_slack` outstanding requests busier than the least busy replica.
+    """
+
+    def __init__(self, host, port, replica_urls, replica_alive, affinity_slack=8):
+        super().__init__(host, port)
+        self._replica_urls = replica_urls
+        self._replica_alive = replica_alive
+        self._affinity_slack = affinity_slack
+        self._outstanding = [0] * len(replica_urls)
+        self._served = [0] * len(replica_urls)
+        self._affinity = {}
+
+    def _choose_replica(self, model):
+        alive = [i for i in range(len(self._replica_urls)) if self._replica_alive(i)]
+        if not alive:
+            raise RuntimeError("All server replicas are down.")
+
+        least_busy = min(alive, key=lambda i: self._outstanding[i])
+        affine = [i for i in self._affinity.get(model, []) if i in alive]
+        if affine:
+            candidate = min(affine, key=lambda i: self._outstanding[i])
+            slack = self._outstanding[candidate] - self._outstanding[least_busy]
+            if slack <= self._affinity_slack:
+                return candidate
+
+        # Load the adapter onto one more replica
+        self._affinity.setdefault(model, []).append(least_busy)
+        self._logger.debug(f"Routing model '{model}' to replica {least_busy}.")
+        return least_busy
+
+    async def _handle(self, request):
+        body = await request.read()
+        model = None
+        if body:
+            try:
+                model = json.loads(body).get("model")
+            except (ValueError, AttributeError):
+                pass
+
+        try:
+            i = self._choose_replica(model)
+        except RuntimeError as error:
+            return web.Response(status=503, text=str(error))
+
+        url = self._replica_urls[i] + request.rel_url.path_qs
+        self._outstanding[i] += 1
+        try:
+            return await self._forward(request, body, url)
+        finally:
+            self._outstanding[i] -= 1
+            self._served[i] += 1
+
+    def start(self):
+        super().start()
+        self._logger.info(
+            f"Router listening on {self._host}:{self.port} "
+            f"({len(self._replica_urls)} replicas)."
+        )
+
+    def stop(self):
+        super().stop()
+        self._logger.debug(f"Requests served per replica: {self._served}")
+
+
+class AIMDLimiter:
+    """
+    A concurrency limit that adapts like TCP congestion control (additive
+    increase, multiplicative decrease).
+
+    Each successful request raises the limit by `1 / limit`, i.e. by about one
+    per round trip. A rate-limited (429) or overloaded (5xx) response, or one
+    slower than `target_latency` seconds, multiplies the limit by `backoff`.
+    Requests that started before the last decrease don't decrease it again.
+    """
+
+    def __init__(
+        self, name, initial_limit, max_limit, target_latency, min_limit=1, backoff=0.5
+    ):
+        self._logger = logging.getLogger("pipeline")
+        self.name = name
+        self.limit = float(min(initial_limit, max_limit))
+        self._max_limit = max_limit
+        self._min_limit = min_limit
+        self._target_latency = target_latency
+        self._backoff = backoff
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = None
+        self.num_requests = 0
+        self.total_latency = 0.0
+
+    async def acquire(self):
+        """
+        Wait for a free slot and return the request's start time.
+        """
+
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        return monotonic()
+
+    async def release(self, start_time, status):
+        latency = monotonic() - start_time
+        self.num_requests += 1
+        self.total_latency += latency
+
+        async with self._condition:
+            self._in_flight -= 1
+            # Inside the lock, so that only the change by this request is logged
+            previous_limit = int(self.limit)
+            congested = status == 429 or status >= 500
+            if congested or latency > self._target_latency:
+                if start_time > self._last_decrease:
+                    self.limit = max(self._min_limit, self.limit * self._backoff)
+                    self._last_decrease = monotonic()
+            else:
+                self.limit = min(self._max_limit, self.limit + 1 / self.limit)
+            limit = int(self.limit)
+            self._condition.notify_all()
+
+        if limit < previous_limit:
+            self._logger.info(
+                f"Concurrency limit for {self.name} decreased to {limit} "
+                f"(status {status}, latency {latency:.1f}s)."
+            )
+        elif limit > previous_limit:
+            self._logger.debug(
+                f"Concurrency limit for {self.name} increased to {limit}."
+            )
+
+
+class ThrottlingProxy(_Proxy):
+    """
+    An HTTP proxy that forwards requests to `upstream_url`, keeping the number
+    of requests in flight below the adaptive limit of an `AIMDLimiter`.
+    """
+
+    def __init__(self, host, port, upstream_url, limiter):
+        super().__init__(host, port)
+        self._upstream_url = upstream_url.rstrip("/")
+        self.limiter = limiter
+
+    @property
+    def url(self):
+        return f"http://{self._host}:{self.port}"
+
+    async def _handle(self, request):
+        body = await request.read()
+        url = self._upstream_url + request.rel_url.path_qs
+        start_time = await self.limiter.acquire()
+        status = 599  # Counts as congestion if the upstream is unreachable
+        try:
+            response = await self._forward(request, body, url)
+            status = response.status
+            return response
+        finally:
+            await self.limiter.release(start_time, status)
+
+    def start(self):
+        super().start()
+        self._logger.info(
+            f"Throttling requests to {self._upstream_url} via {self.url} "
+            f"(initial concurrency limit: {int(self.limiter.limit)})."
+        )
+
+
+class StubRateLimitedServer(_Proxy):
+    """
+    A stand-in for a rate-limited API: it answers each request after `latency`
+    seconds, unless `max_in_flight` requests are in flight already, in which
+    case it answers `429` right away.
+    """
+
+    def __init__(self, host, port, max_in_flight, latency):
+        super().__init__(host, port)
+        self._max_in_flight = max_in_flight
+        self._latency = latency
+        self._in_flight = 0
+
+    @property
+    def url(self):
+        return f"http://{self._host}:{self.port}"
+
+    async def _handle(self, request):
+        await request.read()
+        if self._in_flight >= self._max_in_flight:
+            return web.Response(status=429)
+        self._in_flight += 1
+        try:
+            await asyncio.sleep(self._latency)
+            return web.json_response({})
+        finally:
+            self._in_flight -= 1
+
+
+def check_limiter(max_in_flight, num_requests, concurrency, latency=0.05):
+    """
+    Send `num_requests` requests, `concurrency` at a time, through a
+    `ThrottlingProxy` to a `StubRateLimitedServer` that allows `max_in_flight`
+    requests in flight. Returns the limiter's final limit and the number of
+    responses per status.
+    """
+
+    host = "127.0.0.1"
+    upstream = StubRateLimitedServer(host, 0, max_in_flight, latency)
+    limiter = AIMDLimiter(
+        name="stub",
+        initial_limit=concurrency,
+        max_limit=concurrency,
+        target_latency=10 * latency,
+    )
+    proxy = ThrottlingProxy(host, 0, upstream_url="", limiter=limiter)
+
+    async def send_requests():
+        semaphore = asyncio.Semaphore(concurrency)
+        async with ClientSession() as session:
+
+            async def send_one():
+                async with semaphore:
+                    async with session.post(proxy.url, json={}) as response:
+                        await response.read()
+                        return response.status
+
+            return await asyncio.gather(*[send_one() for _ in range(num_requests)])
+
+    upstream.start()
+    proxy._upstream_url = upstream.url
+    proxy.start()
+    try:
+        statuses = asyncio.run(send_requests())
+    finally:
+        proxy.stop()
+        upstream.stop()
+    return limiter.limit, Counter(statuses)
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(
+        description="Check the AIMD limiter against a stub rate-limited endpoint."
+    )
+    cli_parser.add_argument("--max-in-flight", type=int, default=8)
+    cli_parser.add_argument("--num-requests", type=int, default=1000)
+    cli_parser.add_argument("--concurrency", type=int, default=64)
+    cli_args = cli_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s | %(message)s")
+
+    limit, statuses = check_limiter(
+        cli_args.max_in_flight, cli_args.num_requests, cli_args.concurrency
+    )
+    print(f"Final limit: {limit:.1f}; responses per status: {dict(statuses)}")
+    # AIMD oscillates between about half the rate limit and just above it
+    assert cli_args.max_in_flight / 2 - 1 <= limit <= cli_args.max_in_flight + 2
+    # Up to `concurrency` requests are rate-limited before the first decrease,
+    # then about one per cycle
+    assert statuses[429] < cli_args.concurrency + 0.1 * cli_args.num_requests
+    print("OK")
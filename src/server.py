@@ -7,41 +7,88 @@ import signal
 import shutil
 
 from src.config import PathProvider, SettingProvider
+from src.devices import assign_devices
+from src.router import Router
+
+_STOP_TIMEOUT = 60  # In seconds
 
 
 class LLMServer:
-    def __init__(self, mode, host, port):
+    """
+    Runs `vllm serve` at `host:port`.
+
+    If the setting `eval:num_replicas` is greater than one, one server replica
+    per device group is started on the subsequent ports instead, and a `Router`
+    at `host:port` spreads requests across them.
+
+    By default, the base model is served with LoRA enabled, so that requests
+    can name any checkpoint. If `model_path` is given (e.g. a model merged by
+    `AdapterMerger`), that model is served instead, without LoRA, under the
+    name of its folder (e.g. `checkpoint-0030`).
+    """
+
+    def __init__(self, mode, host, port, model_path=None):
         self._mode = mode
         self._logger = logging.getLogger("pipeline")
         self._settings = SettingProvider(mode=mode)
         self._paths = PathProvider(mode=mode)
         self._host = host
         self._port = port
-        self._process = None
+        self._model_path = model_path
+        self._num_replicas = self._settings["eval:num_replicas"]
+        self._processes = []
+        self._router = None
         self._client = None
 
+    @property
+    def model_name(self):
+        if self._model_path is None:
+            return self._settings["model_id"]
+        return self._model_path.name
+
+    @property
+    def _replica_ports(self):
+        if self._num_replicas == 1:
+            return [self._port]
+        return [self._port + 1 + i for i in range(self._num_replicas)]
+
     def stop(self):
-        self._process.terminate()
-        self._logger.info("Server stopped gracefully.")
+        if self._router is not None:
+            self._router.stop()
+            self._router = None
+        for process in self._processes:
+            process.terminate()
+        # Wait until the GPU memory is freed, e.g. for an in-process engine
+        for process in self._processes:
+            try:
+                process.wait(timeout=_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self._logger.warning(
+                    f"Server didn't stop within {_STOP_TIMEOUT}s. Killing it."
+                )
+                process.kill()
+                process.wait()
+        if self._processes:
+            self._processes = []
+            self._logger.info("Server stopped gracefully.")
 
     def _interrupt(self):
         self._logger.debug("Server received interrupt signal (SIGINT).")
         self._logger.warning("Server got interrupted.")
         self.stop()
 
-    def _get_env(self):
-        checkpoints_folder_path = self._paths.cache_folder_path / "checkpoints"
-        return {
-            "PATH": os.environ["PATH"],
-            "VLLM_LORA_RESOLVER_CACHE_DIR": checkpoints_folder_path,
-            "VLLM_ALLOW_RUNTIME_LORA_UPDATING": "True",
-        }
+    def _get_env(self, devices=None):
+        env = {"PATH": os.environ["PATH"]}
+        if self._model_path is None:
+            # Model IDs of checkpoints are paths relative to the shared cache folder
+            lora_folder_path = self._paths.shared_cache_folder_path
+            env["VLLM_LORA_RESOLVER_CACHE_DIR"] = lora_folder_path
+            env["VLLM_ALLOW_RUNTIME_LORA_UPDATING"] = "True"
+        if devices is not None:
+            env["CUDA_VISIBLE_DEVICES"] = ",".join(devices)
+        return env
 
-    def start(self):
-        log_file_path = self._paths.outputs_folder_path / "server.log"
-        self._logger.info(
-            f"Starting server (server logs will be at '{log_file_path}')..."
-        )
+    def _get_command(self, port):
         command = [
             shutil.which("vllm"),
             "serve",
@@ -50,49 +97,100 @@ class LLMServer:
             "--host",
             self._host,
             "--port",
-            str(self._port),
+            str(port),
             "--gpu-memory-utilization",
             str(self._settings["eval:gpu_memory_utilization"]),
             "--max-model-len",
             str(self._settings["max_model_len"]),
-            "--enable-lora",
-            "--max-lora-rank",
-            str(self._settings["lora_rank"]),
-            self._settings["model_id"],
         ]
-        env = self._get_env()
+        if self._model_path is None:
+            command.extend(
+                [
+                    "--enable-lora",
+                    "--max-lora-rank",
+                    str(self._settings["lora_rank"]),
+                    self._settings["model_id"],
+                ]
+            )
+        else:
+            command.extend(
+                ["--served-model-name", self.model_name, str(self._model_path)]
+            )
+        return command
+
+    def _replica_alive(self, i):
+        return self._processes[i].poll() is None
 
-        with log_file_path.open("w") as log_file:
-            self._process = subprocess.Popen(
-                command, env=env, stdout=log_file, stderr=log_file
+    def start(self):
+        if self._num_replicas == 1:
+            log_file_paths = [self._paths.outputs_folder_path / "server.log"]
+            device_groups = [None]
+        else:
+            log_file_paths = [
+                self._paths.outputs_folder_path / f"server-{i + 1}.log"
+                for i in range(self._num_replicas)
+            ]
+            device_groups = assign_devices(
+                num_groups=self._num_replicas,
+                group_size=self._settings["tensor_parallel_size"],
             )
+        self._logger.info(
+            f"Starting server (server logs will be at '{log_file_paths[0]}'"
+            f"{' etc.' if len(log_file_paths) > 1 else ''})..."
+        )
+
+        for port, devices, log_file_path in zip(
+            self._replica_ports, device_groups, log_file_paths
+        ):
+            command = self._get_command(port)
+            env = self._get_env(devices)
+
+            with log_file_path.open("w") as log_file:
+                self._processes.append(
+                    subprocess.Popen(command, env=env, stdout=log_file, stderr=log_file)
+                )
+            self._logger.debug(f"Started server using command: {' '.join(command)}")
 
         signal.signal(signal.SIGINT, lambda: self._interrupt())
 
-        self._logger.debug(f"Started server using command: {' '.join(command)}")
         self._logger.info("Server started.")
 
     def ready(self):
         if self._client is None:
             return False
 
-    def wait_until_ready(self):
-        self._logger.info("Waiting for server to get ready...")
+    def _wait_until_replica_ready(self, i, port):
         client = OpenAI(
-            base_url=f"http://{self._host}:{self._port}/v1",
+            base_url=f"http://{self._host}:{port}/v1",
             api_key="none",  # Just to make the OpenAI client happy
         )
         ready = False
 
         while not ready:
+            if not self._replica_alive(i):
+                raise RuntimeError(f"Server on port {port} exited during startup.")
             ready = True
             try:
                 client.chat.completions.create(
-                    model=self._settings["model_id"],
+                    model=self.model_name,
                     messages=[{"role": "user", "content": "Say hi"}],
                 )
             except APIConnectionError:
                 ready = False
                 self._logger.debug("Server is not ready yet.")
                 sleep(10)
+
+    def wait_until_ready(self):
+        self._logger.info("Waiting for server to get ready...")
+        for i, port in enumerate(self._replica_ports):
+            self._wait_until_replica_ready(i, port)
+
+        if self._num_replicas > 1:
+            self._router = Router(
+                host=self._host,
+                port=self._port,
+                replica_urls=[f"http://{self._host}:{p}" for p in self._replica_ports],
+                replica_alive=self._replica_alive,
+            )
+            self._router.start()
         self._logger.info("Server is ready.")
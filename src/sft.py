@@ -1,42 +1,91 @@
 from datasets import Dataset
+from transformers import AutoTokenizer
 from trl import SFTTrainer, SFTConfig
 import logging
 import os
 from peft import LoraConfig
 
+from src.archive import AnswerArchive
 from src.config import PathProvider, SettingProvider
+from src.datagen import MODEL_NAME
+from src.dedup import Deduplicator
+from src.reasoning import join_reasoning, split_reasoning
+from src.throughput import ThroughputLog
 
 
 class SFT:
-    def __init__(self, mode, statements, answers):
+    def __init__(self, mode, statements, variant=None):
         self._mode = mode
+        self._variant = variant
         self._logger = logging.getLogger("pipeline")
         self._statements = statements
-        self._answers = answers
-        self._settings = SettingProvider(mode=mode)
-        self._paths = PathProvider(mode=mode)
+        self._archive = AnswerArchive(mode=mode, variant=variant)
+        self._tokenizer = None
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode, variant=variant)
         self._trainer = None
 
+    def _shorten_reasoning(self, answer):
+        """
+        Apply the setting `sft:reasoning` to the reasoning in `answer`:
+
+        - `full`: Keep the reasoning.
+        - `truncated`: Keep the first `sft:reasoning_budget` tokens of the reasoning.
+        - `none`: Drop the reasoning, i.e. train on the final answer only.
+
+        Returns the shortened answer and the number of tokens removed.
+        """
+
+        reasoning_mode = self._settings["sft:reasoning"]
+        if reasoning_mode == "full":
+            return answer, 0
+
+        reasoning, final_answer = split_reasoning(answer)
+        token_ids = self._tokenizer.encode(reasoning, add_special_tokens=False)
+        if reasoning_mode == "none":
+            kept_token_ids = []
+        else:
+            assert reasoning_mode == "truncated"
+            kept_token_ids = token_ids[: self._settings["sft:reasoning_budget"]]
+        shortened_reasoning = self._tokenizer.decode(kept_token_ids)
+        removed = len(token_ids) - len(kept_token_ids)
+        return join_reasoning(shortened_reasoning, final_answer), removed
+
     def _generate_training_data(self):
-        answers_per_question = self._settings["datagen:answers_per_question"]
-        for j in range(answers_per_question):
-            for statement_id in self._statements.index:
-                statement = self._statements.loc[statement_id]
-                user_message_suffix = self._settings["user_message_suffix"]
-                question = f'"{statement}"\n{user_message_suffix}'
-                answer = self._answers.loc[statement_id, f"Answer {j + 1}"]
-                yield {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": question,
-                        },
-                        {
-                            "role": "assistant",
-                            "content": answer,
-                        },
-                    ]
-                }
+        user_message_suffix = self._settings["user_message_suffix"]
+        rows = self._archive.iter_rows(
+            split="training",
+            model=MODEL_NAME,
+            columns=["statement_id", "sample", "text"],
+        )
+        deduplicator = Deduplicator(mode=self._mode, variant=self._variant)
+        kept_answers = deduplicator.kept_answers()
+        removed_tokens = 0
+        for row in rows:
+            if (row["statement_id"], row["sample"]) not in kept_answers:
+                continue
+            statement = self._statements.loc[row["statement_id"]]
+            question = f'"{statement}"\n{user_message_suffix}'
+            answer, removed = self._shorten_reasoning(row["text"])
+            removed_tokens += removed
+            yield {
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": question,
+                    },
+                    {
+                        "role": "assistant",
+                        "content": answer,
+                    },
+                ]
+            }
+
+        if removed_tokens > 0:
+            self._logger.info(
+                f"Removed {removed_tokens} reasoning tokens from the training data "
+                f"(`sft:reasoning: {self._settings['sft:reasoning']}`)."
+            )
 
     def _get_sft_config(self):
         # This is Qwen3's official chat template, with one addition: the keywords {% generation %} and {% endgeneration %}.
@@ -46,7 +95,7 @@ class SFT:
             self._paths.repo_folder_path / "chat_template_with_assistant_mask.jinja"
         )
 
-        checkpoints_folder_path = str(self._paths.cache_folder_path / "checkpoints")
+        checkpoints_folder_path = str(self._paths.checkpoints_folder_path)
         packing_enabled = self._settings["sft:packing"]
         model_init_kwargs = {"dtype": "bfloat16"}
         if packing_enabled:
@@ -77,6 +126,7 @@ class SFT:
             logging_first_step=True,
             log_level="debug",
             report_to="wandb",
+            run_name=self._variant,
         )
 
     def _get_peft_config(self):
@@ -99,7 +149,10 @@ class SFT:
 
     def finetune(self):
         self._logger.info("Running SFT...")
-        training_data = Dataset.from_generator(self._generate_training_data)
+        self._tokenizer = AutoTokenizer.from_pretrained(self._settings["model_id"])
+        # Not `Dataset.from_generator`: its cache is keyed by the generator's code,
+        # so it would miss changes to the answer archive or dedup table
+        training_data = Dataset.from_list(list(self._generate_training_data()))
         sft_config = self._get_sft_config()
         peft_config = self._get_peft_config()
         self._logger.debug(
@@ -112,5 +165,16 @@ class SFT:
             args=sft_config,
             peft_config=peft_config,
         )
-        self._trainer.train()
+        train_output = self._trainer.train()
         self._logger.info("SFT completed.")
+
+        num_steps = self._trainer.state.global_step
+        throughput_log = ThroughputLog(mode=self._mode, variant=self._variant)
+        throughput_log.record(
+            "sft:steps_per_s", train_output.metrics["train_steps_per_second"]
+        )
+        throughput_log.record(
+            "sft:examples_per_step",
+            len(training_data) * self._settings["sft:num_epochs"] / num_steps,
+            packing=self._settings["sft:packing"],
+        )
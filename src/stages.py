@@ -0,0 +1,286 @@
+from dataclasses import dataclass, field
+import logging
+from pathlib import Path
+import shutil
+from time import perf_counter
+from typing import Callable
+
+
+_COMPLETE_MARKER_NAME = ".complete"
+
+
+@dataclass
+class Stage:
+    """
+    A step of the pipeline.
+
+    A stage is done once all of its `outputs` exist. Stages without outputs
+    (e.g. starting a server) are ephemeral: they only run when a stage that
+    depends on them runs, and their `teardown` is called as soon as no
+    remaining stage depends on them.
+
+    Resumable stages (e.g. eval) build up their output folders one run at a
+    time. They keep their outputs if they fail, and are only done once they
+    completed; until then, running them again resumes where they stopped.
+    """
+
+    name: str
+    run: Callable[[], None]
+    inputs: list[Path] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+    depends_on: list[str] = field(default_factory=list)
+    teardown: Callable[[], None] | None = None
+    resumable: bool = False
+
+    @property
+    def ephemeral(self):
+        return len(self.outputs) == 0
+
+    def outputs_exist(self):
+        return not self.ephemeral and all(p.exists() for p in self.outputs)
+
+    def done(self):
+        if not self.outputs_exist():
+            return False
+        return not self.resumable or all(
+            (p / _COMPLETE_MARKER_NAME).exists() for p in self.outputs
+        )
+
+    def mark_complete(self):
+        for output_path in self.outputs:
+            (output_path / _COMPLETE_MARKER_NAME).touch()
+
+    def stale(self):
+        """
+        Whether any input was modified after the outputs were (e.g. because an
+        earlier stage re-ran since).
+        """
+
+        if not self.outputs_exist():
+            return False
+        outputs_modified_at = min(p.stat().st_mtime for p in self.outputs)
+        return any(
+            p.exists() and p.stat().st_mtime > outputs_modified_at for p in self.inputs
+        )
+
+
+@dataclass
+class _Decision:
+    stage: Stage
+    action: str  # `run`, `rerun`, `reuse`, `stale`, or `skip`
+    reason: str
+
+
+class StageGraph:
+    """
+    Runs a sequence of `Stage`s, reusing the outputs of those that are done.
+
+    Stages must be added in topological order. By default, all stages are
+    selected, and a selected stage runs unless it is done and up to date. A
+    stage is out of date if an earlier stage that it depends on runs, or ran
+    after it. If a range of stages is selected explicitly (via `first` and/or
+    `last`), the stages that bound it run even if they are done, replacing
+    their previous outputs. Stages outside the range never run; if their
+    outputs are out of date, they are reported as `stale`.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("pipeline")
+        self._stages = {}
+        self.timings = {}
+
+    @property
+    def stage_names(self):
+        return list(self._stages.keys())
+
+    def add(self, stage):
+        for dependency in stage.depends_on:
+            if dependency not in self._stages:
+                raise ValueError(
+                    f"Stage '{stage.name}' depends on unknown stage '{dependency}'."
+                )
+        self._stages[stage.name] = stage
+
+    def _select(self, first, last):
+        names = self.stage_names
+        i = names.index(first) if first is not None else 0
+        j = names.index(last) if last is not None else len(names) - 1
+        if i > j:
+            raise ValueError(f"Stage '{first}' comes after stage '{last}'.")
+        return names[i : j + 1]
+
+    def _upstream(self, stage):
+        """
+        Names of the stages whose outputs `stage` uses.
+        """
+
+        producers = [
+            s.name
+            for s in self._stages.values()
+            if any(p in s.outputs for p in stage.inputs)
+        ]
+        return list(dict.fromkeys(stage.depends_on + producers))
+
+    def plan(self, first=None, last=None):
+        """
+        Decide for each stage whether it will run, be reused, or be skipped.
+        """
+
+        selected = self._select(first, last)
+        forced = {first, last} - {None}
+        actions = {}
+
+        for name, stage in self._stages.items():
+            if stage.ephemeral:
+                continue
+            upstream_actions = {
+                u: actions.get(u, ("skip",))[0] for u in self._upstream(stage)
+            }
+            changed = [u for u, a in upstream_actions.items() if a in ["run", "rerun"]]
+            stale = [u for u, a in upstream_actions.items() if a == "stale"]
+            if changed:
+                change = f"inputs change ({', '.join(changed)})"
+            elif stage.stale():
+                change = "inputs changed"
+            else:
+                change = None
+
+            if name not in selected:
+                if not stage.done():
+                    actions[name] = ("skip", "not selected")
+                elif change is not None:
+                    actions[name] = ("stale", f"{change}; not selected")
+                elif stale:
+                    actions[name] = ("stale", f"inputs are stale ({', '.join(stale)})")
+                else:
+                    actions[name] = ("reuse", "outputs exist")
+            elif not stage.outputs_exist():
+                actions[name] = ("run", "outputs missing")
+            elif name in forced:
+                actions[name] = ("rerun", "selected explicitly")
+            elif change is not None:
+                actions[name] = ("rerun", change)
+            elif not stage.done():
+                actions[name] = ("run", "incomplete; resuming")
+            else:
+                actions[name] = ("reuse", "outputs exist")
+
+        # Ephemeral stages only run if a running stage needs them
+        for name, stage in reversed(self._stages.items()):
+            if not stage.ephemeral:
+                continue
+            dependents = [
+                s.name
+                for s in self._stages.values()
+                if name in s.depends_on
+                and actions.get(s.name, ("skip",))[0] in ["run", "rerun"]
+            ]
+            if dependents:
+                actions[name] = ("run", f"needed by {', '.join(dependents)}")
+            else:
+                actions[name] = ("skip", "not needed")
+
+        decisions = [_Decision(s, *actions[s.name]) for s in self._stages.values()]
+        self._check_dependencies(decisions)
+        return decisions
+
+    def _check_dependencies(self, decisions):
+        available = set()
+        for d in decisions:
+            if d.action == "skip":
+                continue
+            if d.action in ["run", "rerun"]:
+                for dependency in d.stage.depends_on:
+                    if dependency not in available:
+                        raise RuntimeError(
+                            f"Stage '{d.stage.name}' needs the outputs of stage "
+                            f"'{dependency}', which are missing. Select a range of "
+                            f"stages that includes '{dependency}'."
+                        )
+                for input_path in d.stage.inputs:
+                    producers = [
+                        s for s in available if input_path in self._stages[s].outputs
+                    ]
+                    if not producers and not input_path.exists():
+                        raise RuntimeError(
+                            f"Stage '{d.stage.name}' needs '{input_path}', "
+                            "which does not exist."
+                        )
+            available.add(d.stage.name)
+
+    def describe(self, decisions):
+        width = max([10] + [len(d.stage.name) for d in decisions])
+        lines = [f"{'Stage':{width}} | {'Action':6} | Reason"]
+        for d in decisions:
+            lines.append(f"{d.stage.name:{width}} | {d.action:6} | {d.reason}")
+        return "\n".join(lines)
+
+    def _clear_outputs(self, stage):
+        for output_path in stage.outputs:
+            if output_path.is_dir():
+                shutil.rmtree(output_path)
+            elif output_path.exists():
+                output_path.unlink()
+            self._logger.debug(f"Removed previous output '{output_path}'.")
+
+    def _teardown_unneeded(self, started, remaining):
+        """
+        Tear down the started ephemeral stages that no remaining stage needs
+        (e.g. to free the GPU memory held by a server).
+        """
+
+        running = [d.stage for d in remaining if d.action in ["run", "rerun"]]
+        for stage in list(started):
+            if not stage.ephemeral or any(stage.name in s.depends_on for s in running):
+                continue
+            if stage.teardown is not None:
+                stage.teardown()
+            started.remove(stage)
+
+    def run(self, first=None, last=None):
+        decisions = self.plan(first, last)
+        self.timings = {}
+        self._logger.info(f"Pipeline plan:\n{self.describe(decisions)}")
+        started = []
+
+        try:
+            for i, d in enumerate(decisions):
+                if d.action == "stale":
+                    self._logger.warning(
+                        f"The outputs of stage '{d.stage.name}' are out of date "
+                        f"({d.reason})."
+                    )
+                    continue
+                if d.action not in ["run", "rerun"]:
+                    self._logger.debug(f"Stage '{d.stage.name}': {d.action}.")
+                    continue
+                if d.action == "rerun":
+                    self._logger.warning(
+                        f"Replacing the outputs of stage '{d.stage.name}'."
+                    )
+                    self._clear_outputs(d.stage)
+                self._logger.info(f"Running stage '{d.stage.name}'...")
+                started.append(d.stage)
+                start_time = perf_counter()
+                try:
+                    d.stage.run()
+                except BaseException:
+                    # Resumable stages keep the runs they completed
+                    if not d.stage.ephemeral and not d.stage.resumable:
+                        self._clear_outputs(d.stage)
+                    raise
+                if d.stage.resumable:
+                    d.stage.mark_complete()
+                self.timings[d.stage.name] = perf_counter() - start_time
+                self._logger.info(
+                    f"Stage '{d.stage.name}' completed in "
+                    f"{self.timings[d.stage.name]:.1f}s."
+                )
+                self._teardown_unneeded(started, remaining=decisions[i + 1 :])
+        finally:
+            for stage in reversed(started):
+                if stage.teardown is not None:
+                    stage.teardown()
+
+        summary = ", ".join(f"{n}: {s:.1f}s" for n, s in self.timings.items())
+        self._logger.info(f"Stage timings: {summary or 'no stage ran'}.")
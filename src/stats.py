@@ -4,8 +4,10 @@ import zipfile
 import shutil
 import json
 from collections import defaultdict
+import logging
 import math
 from statistics import mean, stdev
+import csv
 from scipy.stats import t, f
 
 
@@ -32,6 +34,8 @@ def load_sample(eval_file_path: Path) -> list[float]:
 
     scores_per_epoch = defaultdict(list)
     for summary in summaries:
+        if summary.get("error") or not summary.get("scores"):
+            continue  # E.g. the sample's grader requests failed
         epoch = summary.get("epoch")
         score = float(summary["scores"]["ahb_scorer"]["value"]["overall"])
         scores_per_epoch[epoch].append(score)
@@ -68,6 +72,44 @@ def compute_ci(sample: list[float], alpha=0.05) -> CI:
     return CI(mean=m, margin=margin)
 
 
+class RunningMean:
+    """
+    The mean and variance of a sample that grows (or shrinks) one value at a
+    time, via Welford's online algorithm.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # Sum of squared deviations from the mean
+
+    def add(self, x: float):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    def remove(self, x: float):
+        if self.n == 1:
+            self.__init__()
+            return
+        self.n -= 1
+        delta = x - self.mean
+        self.mean -= delta / self.n
+        self._m2 -= delta * (x - self.mean)
+
+    def ci(self, alpha=0.05) -> CI:
+        """
+        Like `compute_ci`, but with a margin of `nan` if `n` is less than two.
+        """
+
+        if self.n < 2:
+            return CI(mean=self.mean if self.n else math.nan, margin=math.nan)
+        se = math.sqrt(self._m2 / (self.n - 1)) / math.sqrt(self.n)
+        t_crit = float(t.ppf(1 - alpha / 2, self.n - 1))
+        return CI(mean=self.mean, margin=se * t_crit)
+
+
 def mean_is_smaller(
     sample_x: list[float], sample_y: list[float], alpha=0.05
 ) -> tuple[bool, float]:
@@ -164,6 +206,51 @@ def variance_is_equal(
     return p_value < alpha, p_value
 
 
+def summarize_evals(
+    evals_folder_paths: list[Path], summary_file_path: Path
+) -> list[CI]:
+    """
+    Compute a confidence interval for each eval run found in `evals_folder_paths`
+    (one subfolder per run) and write them to the CSV file `summary_file_path`.
+
+    Runs without any scored sample (e.g. because their batch grading job
+    expired) are left out.
+    """
+
+    logger = logging.getLogger("pipeline")
+    run_folder_paths = sorted(
+        (p for f in evals_folder_paths for p in f.iterdir() if p.is_dir()),
+        key=lambda p: p.name,
+    )
+    rows = []
+    scores = []
+
+    for run_folder_path in run_folder_paths:
+        eval_file_paths = sorted(run_folder_path.glob("*.eval"))
+        if not eval_file_paths:
+            continue
+        # Use the latest log if the run was repeated
+        sample = load_sample(eval_file_paths[-1])
+        if not sample:
+            logger.warning(
+                f"Eval run '{run_folder_path.name}' has no scored samples. Skipping."
+            )
+            continue
+        if len(sample) > 1:
+            ci = compute_ci(sample)
+        else:
+            ci = CI(mean=mean(sample), margin=math.nan)
+        scores.append(ci)
+        rows.append([run_folder_path.name, len(sample), ci.mean, ci.margin])
+
+    with summary_file_path.open("w", newline="") as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(["run_id", "num_epochs", "mean", "margin"])
+        writer.writerows(rows)
+
+    return scores
+
+
 if __name__ == "__main__":
     eval_file_path_x = Path(
         "results/qwen3-32b-antispeciesist/evals/ahb-2-0/01-pre-distill.eval"
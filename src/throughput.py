@@ -0,0 +1,116 @@
+from datetime import datetime
+import json
+
+from src.config import PathProvider, SettingProvider
+
+# The settings that each metric depends on. A record only counts for the
+# current settings if these match.
+METRIC_SETTINGS = {
+    "datagen:tokens_per_s": [  # Per engine
+        "tensor_parallel_size",
+        "max_model_len",
+        "datagen:gpu_memory_utilization",
+    ],
+    "datagen:tokens_per_answer": [
+        "system_message",
+        "user_message_suffix",
+        "max_model_len",
+        "datagen:thinking_budget",
+    ],
+    "dedup:kept_fraction": [
+        "datagen:answers_per_question",
+        "dedup:threshold",
+        "dedup:num_permutations",
+        "dedup:shingle_size",
+    ],
+    "sft:steps_per_s": [
+        "tensor_parallel_size",
+        "max_model_len",
+        "lora_rank",
+        "sft:packing",
+        "sft:reasoning",
+        "sft:reasoning_budget",
+        "sft:per_device_train_batch_size",
+        "sft:gradient_accumulation_steps",
+    ],
+    "sft:examples_per_step": [
+        "max_model_len",
+        "sft:packing",
+        "sft:reasoning",
+        "sft:reasoning_budget",
+        "sft:per_device_train_batch_size",
+        "sft:gradient_accumulation_steps",
+    ],
+    # Including grading time; scaled by `eval:num_replicas` when planning
+    "eval:samples_per_s": [
+        "tensor_parallel_size",
+        "max_model_len",
+        "eval:backend",
+        "eval:grading",
+        "grader_models:refs",
+        "grader_models:max_tokens",
+    ],
+    "eval:dataset_size": [],
+    "grader:latency_s": ["grader_models:refs", "grader_models:max_tokens"],
+    "grader:calls_per_sample": ["grader_models:refs"],
+}
+
+
+class ThroughputLog:
+    """
+    Throughput numbers measured by pipeline runs (e.g. datagen tokens/s), from
+    which the planner estimates how long future runs take.
+
+    Each measurement is appended as a JSON line to `throughput.jsonl` in the
+    history folder, which outlives the cache and outputs folders. Along with
+    it, the model ID, the settings it depends on (see `METRIC_SETTINGS`), and
+    any other `context` (e.g. `num_replicas`) are saved.
+    """
+
+    def __init__(self, mode, variant=None):
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode)
+
+    @property
+    def file_path(self):
+        return self._paths.history_folder_path / "throughput.jsonl"
+
+    def _get_settings(self, metric):
+        return {s: self._settings[s] for s in METRIC_SETTINGS[metric]}
+
+    def record(self, metric, value, **context):
+        record = {
+            "metric": metric,
+            "value": value,
+            "model_id": self._settings["model_id"],
+            "settings": self._get_settings(metric),
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            **context,
+        }
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Appending single lines is safe for concurrent (e.g. data-parallel) writers
+        with self.file_path.open("a") as log_file:
+            log_file.write(json.dumps(record) + "\n")
+
+    def latest(self, metric):
+        """
+        Return the latest record of `metric` for the current model and
+        settings, or `None`.
+        """
+
+        if not self.file_path.is_file():
+            return None
+        model_id = self._settings["model_id"]
+        # Compare as JSON, like the records (e.g. tuples become lists)
+        settings = json.loads(json.dumps(self._get_settings(metric)))
+        latest_record = None
+        with self.file_path.open() as log_file:
+            for line in log_file:
+                record = json.loads(line)
+                if (
+                    record["metric"] == metric
+                    and record["model_id"] == model_id
+                    and record.get("settings") == settings
+                ):
+                    latest_record = record
+        return latest_record
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import pandas as pd
+from openai import AsyncOpenAI
+from tqdm.asyncio import tqdm
+
+from src.archive import AnswerArchive
+from src.config import PathProvider, SettingProvider
+
+
+class Validator:
+    """
+    Samples answers to the validation statements from the "pre-distill" model
+    and all checkpoints, using a running `LLMServer`.
+
+    All requests are sent concurrently, and each model's answers are saved to
+    the `AnswerArchive` once they are in. Models whose answers are saved
+    already (e.g. before the validate stage failed) are skipped.
+
+    In a sweep, the "pre-distill" model is the same for all variants. Hence,
+    `scope` selects which models to sample: `all` of them, only the `shared`
+    "pre-distill" model, or only the checkpoints of the `variant`.
+    """
+
+    def __init__(
+        self, mode, server_host, server_port, statements, variant=None, scope="all"
+    ):
+        self._logger = logging.getLogger("pipeline")
+        self._settings = SettingProvider(mode=mode, variant=variant)
+        self._paths = PathProvider(mode=mode, variant=variant)
+        self._archive = AnswerArchive(mode=mode, variant=variant)
+        self._statements = statements
+        self._scope = scope
+        self._client = AsyncOpenAI(
+            base_url=f"http://{server_host}:{server_port}/v1",
+            api_key="none",  # Just to make the OpenAI client happy
+        )
+        self._column_names = [
+            f"Answer {j + 1}"
+            for j in range(self._settings["validation:answers_per_question"])
+        ]
+
+    def _get_models(self):
+        models = {}
+        if self._scope in ["all", "shared"]:
+            models["pre-distill"] = self._settings["model_id"]
+        if self._scope in ["all", "variant"]:
+            folder_entries = os.listdir(self._paths.checkpoints_folder_path)
+            checkpoint_ids = sorted(
+                [f for f in folder_entries if f.startswith("checkpoint-")]
+            )
+            models.update(
+                {c: self._paths.checkpoint_model_id(c) for c in checkpoint_ids}
+            )
+        return models
+
+    def _get_chat(self, statement):
+        user_message_suffix = self._settings["user_message_suffix"]
+        return [{"role": "user", "content": f'"{statement}"\n{user_message_suffix}'}]
+
+    async def _sample(self, semaphore, run_id, model_id, statement_id):
+        async with semaphore:
+            completion = await self._client.chat.completions.create(
+                model=model_id,
+                messages=self._get_chat(self._statements[statement_id]),
+                n=len(self._column_names),
+                max_tokens=max(  # Reserve space for prompt
+                    100, self._settings["max_model_len"] - 512
+                ),
+            )
+
+        for j, choice in enumerate(completion.choices):
+            if choice.finish_reason != "stop":
+                self._logger.warning(
+                    f"{run_id} | Statement #{statement_id} | Answer {j + 1} invalid "
+                    f"(finish_reason={choice.finish_reason})."
+                )
+        return run_id, statement_id, [c.message.content for c in completion.choices]
+
+    async def _sample_model(self, semaphore, progress, run_id, model_id):
+        answers = pd.DataFrame(index=self._statements.index, columns=self._column_names)
+
+        async def sample(statement_id):
+            result = await self._sample(semaphore, run_id, model_id, statement_id)
+            progress.update()
+            return result
+
+        results = await asyncio.gather(
+            *[sample(statement_id) for statement_id in self._statements.index]
+        )
+        for _, statement_id, texts in results:
+            answers.loc[statement_id, :] = texts
+        self._archive.write(split="validation", model=run_id, answers=answers)
+
+    async def _sample_all(self, models):
+        semaphore = asyncio.Semaphore(self._settings["validation:max_connections"])
+        with tqdm(total=len(models) * len(self._statements)) as progress:
+            await asyncio.gather(
+                *[
+                    self._sample_model(semaphore, progress, run_id, model_id)
+                    for run_id, model_id in models.items()
+                ]
+            )
+
+    def validate(self):
+        models = self._get_models()
+        sampled = [r for r in models if self._archive.contains("validation", r)]
+        if sampled:
+            self._logger.info(
+                f"Found validation answers of {len(sampled)} models. Skipping them."
+            )
+        models = {k: v for k, v in models.items() if k not in sampled}
+        self._logger.info(
+            f"Sampling answers to {len(self._statements)} validation statements "
+            f"from {len(models)} models..."
+        )
+        asyncio.run(self._sample_all(models))
+        validation_folder_path = self._archive.partition_path(split="validation")
+        self._logger.info(f"Validation answers saved to '{validation_folder_path}'.")
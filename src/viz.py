@@ -1,8 +1,18 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
 from pathlib import Path
+import re
+import kaleido
 import plotly.graph_objects as go
 
 from stats import CI, compute_ci, load_sample
 
+# Log names that inspect generates, e.g. `2025-11-03T10-12-54+00-00_ahb_Xc9...`
+_GENERATED_LOG_NAME = re.compile(r"^\d{4}-\d{2}-\d{2}T")
+
 
 def _get_file_paths(folder_path: Path, file_ending: str) -> list[Path]:
     file_paths = []
@@ -12,12 +22,12 @@ def _get_file_paths(folder_path: Path, file_ending: str) -> list[Path]:
     return file_paths
 
 
-def plot_scores(
+def _build_scores_figure(
     scores: list[CI],
     labels: list[str],
     group_labels: list[str] | None = None,
     group_ranges: list[tuple[int, int]] | None = None,
-) -> None:
+) -> go.Figure:
     """
     Plot the given `scores`.
 
@@ -100,10 +110,245 @@ def plot_scores(
             # paper_bgcolor="LightSteelBlue",
         )
 
+    return fig
+
+
+def plot_scores(
+    scores: list[CI],
+    labels: list[str],
+    group_labels: list[str] | None = None,
+    group_ranges: list[tuple[int, int]] | None = None,
+) -> None:
+    """
+    Plot the given `scores` (see `_build_scores_figure`) to `figure.png`.
+    """
+
+    fig = _build_scores_figure(scores, labels, group_labels, group_ranges)
     fig.write_image("figure.png", scale=3)
 
 
-if __name__ == "__main__":
+def _build_learning_curve_figure(
+    title: str, steps: list[int], scores: list[CI], references: dict[str, CI]
+) -> go.Figure:
+    """
+    Plot the `scores` of the checkpoints against their SFT `steps`, and the
+    `references` (e.g. the "pre-distill" model) as horizontal lines.
+    """
+
+    font_size = 16
+
+    fig = go.Figure(
+        data=go.Scatter(
+            x=steps,
+            y=[s.mean for s in scores],
+            mode="lines+markers",
+            error_y=dict(
+                type="data",
+                symmetric=True,
+                array=[s.margin for s in scores],
+                thickness=2,
+                width=6,
+            ),
+            marker=dict(size=8),
+            name="Checkpoints",
+        )
+    )
+    for label, score in references.items():
+        fig.add_hline(
+            y=score.mean,
+            line=dict(dash="dash", width=1),
+            annotation_text=label,
+            annotation_position="top left",
+        )
+
+    fig.update_layout(
+        width=800,
+        height=450,
+        font=dict(size=font_size),
+        title=title,
+        xaxis_title="SFT step",
+        yaxis_title="AHB Score",
+        template="plotly_white",
+        showlegend=False,
+    )
+    return fig
+
+
+class _ScoreCache:
+    """
+    The samples (i.e. mean score per epoch) of `.eval` logs, saved to
+    `file_path` so that each log is only loaded once, unless it changed.
+    """
+
+    def __init__(self, file_path: Path):
+        self._file_path = file_path
+        self._entries = {}
+        if file_path.is_file():
+            self._entries = json.loads(file_path.read_text())
+
+    def get(self, eval_file_path: Path) -> list[float]:
+        stat = eval_file_path.stat()
+        key = str(eval_file_path.resolve())
+        entry = self._entries.get(key)
+        if entry is None or entry["modified_at"] != stat.st_mtime_ns:
+            entry = {
+                "modified_at": stat.st_mtime_ns,
+                "sample": load_sample(eval_file_path),
+            }
+            self._entries[key] = entry
+        return entry["sample"]
+
+    def save(self):
+        self._file_path.write_text(json.dumps(self._entries, indent=1))
+
+
+def _to_ci(sample: list[float]) -> CI:
+    if len(sample) > 1:
+        return compute_ci(sample)
+    return CI(mean=sum(sample) / len(sample), margin=math.nan)
+
+
+def _discover_runs(root_folder_paths: list[Path]) -> dict[Path, dict[str, Path]]:
+    """
+    Find all `.eval` logs in `root_folder_paths`, and return, for each folder
+    of eval runs, the log of each run (the latest one if a run was repeated).
+
+    Supports both the pipeline's layout (`evals/<run ID>/<generated name>.eval`)
+    and that of `results` (`evals/.../<optional number>-<run ID>.eval`).
+    """
+
+    runs = {}
+    for eval_file_path in sorted(
+        p for f in root_folder_paths for p in f.rglob("*.eval")
+    ):
+        if _GENERATED_LOG_NAME.match(eval_file_path.stem):
+            run_id = eval_file_path.parent.name
+            evals_folder_path = eval_file_path.parent.parent
+        else:
+            run_id = re.sub(r"^\d+-", "", eval_file_path.stem)
+            evals_folder_path = eval_file_path.parent
+        # Sorted by name, so later logs replace earlier ones
+        runs.setdefault(evals_folder_path, {})[run_id] = eval_file_path
+    return runs
+
+
+def _build_report_figures(
+    evals_folder_path: Path, run_scores: dict[str, CI]
+) -> dict[str, go.Figure]:
+    title = str(evals_folder_path)
+    figures = {}
+    checkpoint_ids = sorted(r for r in run_scores if r.startswith("checkpoint-"))
+    references = {
+        label: run_scores[run_id]
+        for run_id, label in [
+            ("pre-distill", "Base model"),
+            ("pre-distill-prompted", "In-context learning"),
+        ]
+        if run_id in run_scores
+    }
+
+    if checkpoint_ids:
+        figures["learning-curve"] = _build_learning_curve_figure(
+            title=title,
+            steps=[int(c.removeprefix("checkpoint-")) for c in checkpoint_ids],
+            scores=[run_scores[c] for c in checkpoint_ids],
+            references=references,
+        )
+
+    # Without a "post-distill" run, the last checkpoint is the post-distill model
+    post_distill_run_id = "post-distill" if "post-distill" in run_scores else None
+    if post_distill_run_id is None and checkpoint_ids:
+        post_distill_run_id = checkpoint_ids[-1]
+    if references and post_distill_run_id is not None:
+        labels = list(references) + ["Context<br />distillation"]
+        scores = list(references.values()) + [run_scores[post_distill_run_id]]
+        figures["pre-post"] = _build_scores_figure(scores, labels=labels)
+        figures["pre-post"].update_layout(title=title, margin=dict(t=60))
+    return figures
+
+
+async def _export_figures(figures: dict[Path, go.Figure], num_workers: int):
+    # A single renderer session, with `num_workers` figures rendered in parallel
+    async with kaleido.Kaleido(n=num_workers) as renderer:
+        await renderer.write_fig_from_object(
+            [
+                {"fig": fig, "path": path, "opts": {"scale": 3}}
+                for path, fig in figures.items()
+            ],
+            cancel_on_error=True,
+        )
+
+
+def _get_figure_name_prefix(
+    evals_folder_path: Path, root_folder_paths: list[Path]
+) -> str:
+    """
+    Name figures after the folder of eval runs, relative to its root (e.g.
+    `outputs--evals` for `/tmp/outputs/evals`), so that they stay in the
+    report folder for absolute roots, too.
+    """
+
+    root_folder_path = next(
+        r for r in root_folder_paths if evals_folder_path.is_relative_to(r)
+    )
+    relative_path = evals_folder_path.relative_to(root_folder_path)
+    parts = [root_folder_path.resolve().name, *relative_path.parts]
+    return "--".join(p for p in parts if p)
+
+
+def render_report(
+    root_folder_paths: list[Path], report_folder_path: Path, num_workers: int = 4
+) -> None:
+    """
+    Render figures for all eval runs found in `root_folder_paths` to
+    `report_folder_path`: per folder of eval runs, the scores of the
+    checkpoints against their SFT step, and the scores before and after
+    context distillation.
+
+    Figures that are unchanged since the last report are not exported again.
+    """
+
+    report_folder_path.mkdir(parents=True, exist_ok=True)
+    score_cache = _ScoreCache(report_folder_path / "scores-cache.json")
+    manifest_file_path = report_folder_path / "manifest.json"
+    manifest = {}
+    if manifest_file_path.is_file():
+        manifest = json.loads(manifest_file_path.read_text())
+
+    figures = {}
+    for evals_folder_path, run_file_paths in _discover_runs(root_folder_paths).items():
+        run_scores = {}
+        for run_id, eval_file_path in run_file_paths.items():
+            sample = score_cache.get(eval_file_path)
+            if not sample:  # E.g. if its batch grading job expired
+                print(f"Eval run '{eval_file_path}' has no scored samples. Skipping.")
+                continue
+            run_scores[run_id] = _to_ci(sample)
+        figure_name_prefix = _get_figure_name_prefix(
+            evals_folder_path, root_folder_paths
+        )
+        for name, fig in _build_report_figures(evals_folder_path, run_scores).items():
+            figures[report_folder_path / f"{figure_name_prefix}--{name}.png"] = fig
+    score_cache.save()
+
+    changed_figures = {}
+    for path, fig in figures.items():
+        fingerprint = hashlib.sha256(fig.to_json().encode()).hexdigest()
+        if manifest.get(path.name) != fingerprint or not path.is_file():
+            changed_figures[path] = fig
+            manifest[path.name] = fingerprint
+
+    print(
+        f"Exporting {len(changed_figures)} of {len(figures)} figures "
+        f"({len(figures) - len(changed_figures)} unchanged)..."
+    )
+    if changed_figures:
+        asyncio.run(_export_figures(changed_figures, num_workers))
+    manifest_file_path.write_text(json.dumps(manifest, indent=1))
+    print(f"Report saved to '{report_folder_path}'.")
+
+
+def _plot_main_figure():
     file_paths = [
         Path("results/qwen3-32b-speciesist/evals/ahb-2-0/pre-distill-prompted.eval"),
         Path("results/qwen3-32b-speciesist/evals/ahb-2-0/post-distill.eval"),
@@ -134,3 +379,32 @@ if __name__ == "__main__":
         group_labels=group_labels,
         group_ranges=group_ranges,
     )
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(description="Plot AHB scores.")
+    subparsers = cli_parser.add_subparsers(dest="command")
+    report_parser = subparsers.add_parser(
+        "report", help="Render figures for all eval runs"
+    )
+    report_parser.add_argument(
+        "roots",
+        nargs="*",
+        type=Path,
+        default=[Path("results"), Path("outputs")],
+        help="Folders to search for `.eval` logs",
+    )
+    report_parser.add_argument("--report-folder", type=Path, default=Path("report"))
+    report_parser.add_argument(
+        "--num-workers", type=int, default=4, help="Figures to export in parallel"
+    )
+    cli_args = cli_parser.parse_args()
+
+    if cli_args.command == "report":
+        render_report(
+            [r for r in cli_args.roots if r.is_dir()],
+            report_folder_path=cli_args.report_folder,
+            num_workers=cli_args.num_workers,
+        )
+    else:
+        _plot_main_figure()